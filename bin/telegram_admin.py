@@ -2,11 +2,16 @@
 
 from __future__ import print_function
 import argparse
+import csv
 import json
+import multiprocessing
 import os
+import sys
+import time
 from getpass import getpass
-from telegram.auth.internal import hashpass
+from telegram.auth.passwords import hash_password
 from telegram.auth.sign import generate_key_pair
+from telegram.directory import SQLiteDirectory, open_directory, read_passwd, update_passwd
 
 
 parser = argparse.ArgumentParser('telegram-client')
@@ -24,6 +29,15 @@ adduser_parser.add_argument('--email', '-e', help="The email of the new user")
 adduser_parser.add_argument('--password', '-p', help="The password (specified by hidden input if omitted)")
 adduser_parser.add_argument('--admin', '-a', action="store_true", help="Give the user admin rights")
 
+migrate_parser = subparsers.add_parser('migrate', help="Copy users.json and passwd into an SQLite user directory")
+migrate_parser.add_argument('--path', help="The database file (default from office.json, or users.db)")
+
+import_parser = subparsers.add_parser('import', help="Add many users from a CSV or JSON-lines file")
+import_parser.add_argument('filename', help="Users with username, password and optionally fullname, email and admin")
+import_parser.add_argument('--format', choices=['csv', 'jsonl'], help="The file format (default from the file name)")
+import_parser.add_argument('--processes', '-j', type=int, default=multiprocessing.cpu_count(), help="Number of key generating processes (default one per CPU)")
+import_parser.add_argument('--checkpoint', help="File keeping finished users, to resume an interrupted import (default FILENAME.done)")
+
 args = parser.parse_args()
 
 config_dir = os.path.expanduser(args.config_dir)
@@ -36,23 +50,66 @@ if not os.path.exists(config_dir):
 
 
 try:
-    with open(users_filename, 'r') as f:
-        users = json.load(f)
+    with open(os.path.join(config_dir, 'office.json'), 'r') as f:
+        directory_settings = json.load(f).get('directory', {})
 except IOError:
-    print("No users.json found!")
-    users = {}
+    directory_settings = {}
+
+directory = None if args.command == 'migrate' else open_directory(directory_settings, config_dir)
+
+if directory is not None:
+    users = directory
+else:
+    try:
+        with open(users_filename, 'r') as f:
+            users = json.load(f)
+    except IOError:
+        print("No users.json found!")
+        users = {}
 
 
 def print_user(username):
-    user = users[username]
+    user = users.get(username)
     print(username + ':')
     print('  Full name: ' + user.get('fullname'))
     print('     E-mail: ' + user.get('email'))
     print('      Admin: ' + ('yes' if user.get('admin', False) else 'no'))
 
+def read_records(filename, format):
+    with open(filename, 'r') as f:
+        if format == 'csv':
+            for record in csv.DictReader(f):
+                yield record
+        else:
+            for l in f:
+                if l.strip():
+                    yield json.loads(l)
+
+
+def make_user(record):
+    # runs in a pool process
+    username = record['username']
+    private_key, public_key = generate_key_pair(username)
+    user = {
+        'fullname': record.get('fullname') or username,
+        'email': record.get('email') or None,
+        'admin': str(record.get('admin', '')).lower() in ('1', 'true', 'yes'),
+        'private_key': _text(private_key),
+        'public_key': _text(public_key),
+    }
+    return username, user, hash_password(record['password'])
+
+
+def _text(key):
+    return key.decode('ascii') if isinstance(key, bytes) else key
+
+
 def store_users():
-    with open(users_filename, 'w') as f:
+    # write aside and rename, so a running server never reads a half written file
+    temp_filename = users_filename + '.tmp'
+    with open(temp_filename, 'w') as f:
         json.dump(users, f, indent=2)
+    os.rename(temp_filename, users_filename)
 
 if args.command == 'showuser':
     if args.username in users:
@@ -76,12 +133,6 @@ elif args.command == 'adduser':
     else:
         password = args.password
 
-    with open(passwd_filename, 'a') as f:
-        f.write(args.username)
-        f.write(':')
-        f.write(hashpass(password))
-        f.write('\n')
-
     private_key, public_key = generate_key_pair(args.username)
 
     user = {
@@ -92,7 +143,91 @@ elif args.command == 'adduser':
         'public_key': public_key,
     }
 
-    users[args.username] = user
-    store_users()
+    if directory is not None:
+        directory.add(args.username, user, hash_password(password))
+    else:
+        update_passwd(passwd_filename, {args.username: hash_password(password)})
+
+        users[args.username] = user
+        store_users()
     print_user(args.username)
 
+elif args.command == 'migrate':
+    path = args.path or directory_settings.get('path', 'users.db')
+    directory = SQLiteDirectory(os.path.join(config_dir, path))
+    passwords = read_passwd(passwd_filename) if os.path.exists(passwd_filename) else {}
+    skipped = directory.import_users(users, passwords)
+    for username in skipped:
+        print('Skipping existing user %s.' % username)
+    print('Copied %i users into %s.' % (len(set(users) | set(passwords)) - len(skipped),
+                                        directory.filename))
+    print('Set "directory": {"backend": "sqlite", "path": "%s"} in office.json to use it.' % path)
+
+elif args.command == 'import':
+    format = args.format or ('csv' if args.filename.endswith('.csv') else 'jsonl')
+    checkpoint_filename = args.checkpoint or args.filename + '.done'
+
+    # users finished by an earlier, interrupted run
+    done = {}
+    if os.path.exists(checkpoint_filename):
+        with open(checkpoint_filename, 'r') as f:
+            for l in f:
+                try:
+                    record = json.loads(l)
+                except ValueError:
+                    continue  # the line being written when the run was stopped
+                done[record['username']] = (record['username'], record['user'],
+                                            record['password'])
+        print('Resuming after %i users from %s.' % (len(done), checkpoint_filename))
+
+    records = []
+    for record in read_records(args.filename, format):
+        if record.get('username') is None or record.get('password') is None:
+            print('Skipping a record without username or password: %r' % record.get('username'))
+        elif record['username'] in users:
+            print('Skipping existing user %s.' % record['username'])
+        elif record['username'] not in done:
+            records.append(record)
+
+    # the checkpoint holds private keys
+    fd = os.open(checkpoint_filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+    started = time.time()
+    pool = multiprocessing.Pool(args.processes)
+    with os.fdopen(fd, 'a') as checkpoint:
+        for count, result in enumerate(pool.imap_unordered(make_user, records), 1):
+            done[result[0]] = result
+            checkpoint.write(json.dumps({'username': result[0], 'user': result[1],
+                                         'password': result[2]}) + '\n')
+            checkpoint.flush()
+            if count % 10 == 0 or count == len(records):
+                rate = count / (time.time() - started)
+                sys.stdout.write('\rGenerated %i/%i users, %.1f/s, %.0f s left   ' % (
+                    count, len(records), rate, (len(records) - count) / rate))
+                sys.stdout.flush()
+    pool.close()
+    pool.join()
+    if records:
+        print()
+
+    new_users = {username: user for username, user, password in done.values()}
+    new_passwords = {username: password for username, user, password in done.values()}
+    # users may have been added while the keys were generated; those are not overwritten
+    if directory is not None:
+        skipped = directory.import_users(new_users, new_passwords)
+    else:
+        try:
+            with open(users_filename, 'r') as f:
+                users = json.load(f)
+        except IOError:
+            pass
+        skipped = [username for username in new_users if username in users]
+        for username in skipped:
+            del new_passwords[username]
+        skipped.extend(update_passwd(passwd_filename, new_passwords, replace=False))
+        users.update((username, user) for username, user in new_users.items()
+                     if username not in skipped)
+        store_users()
+    for username in sorted(skipped):
+        print('Skipping user %s, added while importing.' % username)
+    os.unlink(checkpoint_filename)
+    print('Imported %i users.' % (len(done) - len(skipped)))
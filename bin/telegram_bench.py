@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from gevent.pool import Pool
+from telegram.auth.crypto_pool import CryptoPool
+from telegram.auth.sign import generate_key_pair, RSASigner, RSAVerifier
+from telegram.post.inbox import JournaledInbox
+from telegram.post.office import _clean_body, _BodyCleaner
+
+
+parser = argparse.ArgumentParser('telegram-bench')
+
+subparsers = parser.add_subparsers(dest="command", help="Sub-commands")
+
+clean_body_parser = subparsers.add_parser('clean-body', help="Throughput of the body sanitizer")
+clean_body_parser.add_argument('--sizes', '-s', default='1024,102400,10485760',
+                               help="Comma separated body sizes in bytes (default 1 KB, 100 KB, 10 MB)")
+clean_body_parser.add_argument('--chunk-size', '-k', type=int, default=0,
+                               help="Feed the body in chunks of this size (default all at once)")
+clean_body_parser.add_argument('--seconds', '-t', type=float, default=1.0,
+                               help="Minimum run time per size")
+
+crypto_parser = subparsers.add_parser('crypto', help="Verified messages/s, inline versus pooled")
+crypto_parser.add_argument('--workers', '-w', type=int, default=4,
+                           help="Number of crypto worker processes (default 4)")
+crypto_parser.add_argument('--messages', '-m', type=int, default=2000,
+                           help="Number of messages to verify (default 2000)")
+
+recovery_parser = subparsers.add_parser('inbox-recovery', help="Restart time of the journaled inbox")
+recovery_parser.add_argument('--messages', '-m', type=int, default=1000000,
+                             help="Number of queued messages (default 1000000)")
+recovery_parser.add_argument('--users', '-u', type=int, default=1000,
+                             help="Number of inboxes (default 1000)")
+recovery_parser.add_argument('--body-size', '-b', type=int, default=100,
+                             help="Body size in bytes (default 100)")
+
+args = parser.parse_args()
+
+
+def measure(function, seconds):
+    """
+    Call a function repeatedly for at least the given time.
+
+    :rtype: tuple of [int, float] The number of calls and the elapsed time
+    """
+    calls = 0
+    start = time.time()
+    elapsed = 0.0
+    while elapsed < seconds:
+        function()
+        calls += 1
+        elapsed = time.time() - start
+    return calls, elapsed
+
+
+def make_body(size):
+    pattern = u'Hello <b class="x>y">world</b>, it\'s <i>me</i> > you. '
+    return (pattern * (size // len(pattern) + 1))[:size]
+
+
+if args.command == 'clean-body':
+    for size in [int(s) for s in args.sizes.split(',')]:
+        body = make_body(size)
+
+        if args.chunk_size:
+            def run():
+                cleaner = _BodyCleaner()
+                for offset in range(0, len(body), args.chunk_size):
+                    cleaner.feed(body[offset:offset + args.chunk_size])
+        else:
+            def run():
+                _clean_body(body)
+
+        calls, elapsed = measure(run, args.seconds)
+        print('%10i bytes: %8.1f bodies/s %8.1f MB/s' % (
+            size, calls / elapsed, calls * size / elapsed / 1e6))
+
+elif args.command == 'crypto':
+    private_key, public_key = generate_key_pair('bench')
+    signer = RSASigner(lambda username: private_key)
+    verifier = RSAVerifier(lambda username: public_key)
+    messages = [u'Message number %i' % n for n in range(args.messages)]
+    signatures = [signer.sign('bench', message) for message in messages]
+
+    def verify_all():
+        greenlets = Pool(args.workers * 4)
+        results = greenlets.map(lambda n: verifier.verify('bench', signatures[n], messages[n]),
+                                range(args.messages))
+        assert all(results), 'Verification failed'
+
+    start = time.time()
+    verify_all()
+    inline = args.messages / (time.time() - start)
+    print('  inline: %8.1f messages/s' % inline)
+
+    verifier.executor = CryptoPool(args.workers)
+    start = time.time()
+    verify_all()
+    pooled = args.messages / (time.time() - start)
+    verifier.executor.close()
+    print('  pooled: %8.1f messages/s with %i workers (%.1fx)' % (
+        pooled, args.workers, pooled / inline))
+
+elif args.command == 'inbox-recovery':
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'inbox')
+    users = ['user%i' % n for n in range(args.users)]
+    body = make_body(args.body_size)
+
+    def fill(inbox, count):
+        start = time.time()
+        for n in range(count):
+            username = users[n % len(users)]
+            inbox.put(username, {'x-telegram-from': 'bench', 'x-telegram-to': username}, body)
+        inbox.flush()
+        return count / (time.time() - start)
+
+    def recover():
+        start = time.time()
+        inbox = JournaledInbox(path, snapshot_interval=0)
+        elapsed = time.time() - start
+        size = sum(inbox.size(username) for username in users)
+        return inbox, size, elapsed
+
+    try:
+        inbox = JournaledInbox(path, snapshot_interval=0)
+        for username in users:
+            inbox.create(username)
+        rate = fill(inbox, args.messages)
+        inbox.close()
+        print('     journal: %8.1f puts/s, %.1f MB' % (
+            rate, os.path.getsize(path + '.journal.0') / 1e6))
+
+        inbox, size, elapsed = recover()
+        print('  replay all: %8.2f s for %i messages' % (elapsed, size))
+
+        start = time.time()
+        inbox.snapshot()
+        forked = time.time() - start
+        inbox._child.join()
+        print('    snapshot: %8.3f s in the server, %.2f s in total, %.1f MB' % (
+            forked, time.time() - start, os.path.getsize(path + '.snapshot') / 1e6))
+        fill(inbox, args.messages // 10)
+        inbox.close()
+
+        inbox, size, elapsed = recover()
+        print('    snapshot: %8.2f s for %i messages, %i of them from the journal' % (
+            elapsed, size, args.messages // 10))
+        inbox.close()
+    finally:
+        shutil.rmtree(directory)
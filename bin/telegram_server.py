@@ -3,10 +3,24 @@
 from __future__ import print_function
 import argparse
 import os
+import signal
+import socket as sockets
+import struct
+import time
+from collections import deque
 from gevent import monkey; monkey.patch_all()
-from telegram.post.office import PostOffice
-from telegram.auth.session import SessionHandler
+import gevent
+from gevent.queue import Queue, Empty
+from telegram.post.office import PostOffice, LongPollLimit
+from telegram.post.admission import RateLimited, Overloaded, InboxFull
+from telegram.post.listeners import ListenerBusy
+from telegram.auth.session import open_session_handler
 from telegram.auth.internal import InternalAuth
+from telegram import log as logs
+from telegram import metrics
+from telegram.framing import get_framing
+from telegram.connections import ConnectionManager, TooManySockets
+from telegram.watcher import FileWatcher
 from bottle import debug, request, response, Bottle, HTTPError, HTTPResponse, static_file, abort, redirect
 from gevent.pywsgi import WSGIServer
 from geventwebsocket import WebSocketError
@@ -15,20 +29,48 @@ import json
 
 parser = argparse.ArgumentParser('telegram-client')
 parser.add_argument('--config-dir', '-c', default='~/.telegram', help='config file location (default ~/.telegram)')
+parser.add_argument('--workers', '-w', type=int, default=1, help='number of worker processes (default 1)')
+parser.add_argument('--log-level', choices=['debug', 'info', 'warning', 'error'], help='log level (default from office.json, or info)')
+parser.add_argument('--log-json', action='store_true', help='log one JSON object per line')
+parser.add_argument('--log-file', help='log to this file instead of stderr')
 args = parser.parse_args()
 
 config_dir = os.path.expanduser(args.config_dir)
 
 telegram = Bottle()
+log = logs.get_logger('telegram.server')
 
-internal_auth = InternalAuth(config_dir)
-sessions = SessionHandler()
-post_office = PostOffice(config_dir)
+# created by setup() in each worker process
+internal_auth = None
+post_office = None
+sessions = None
+connections = None
+
+PORT = 8080
+
+# seconds a worker waits for open requests and sockets to finish after SIGTERM
+DRAIN_TIMEOUT = 30
 
 MEDIA_ROOT='/home/johan/git/telegram/media'
 EMOTICON_ROOT = os.path.join(MEDIA_ROOT, 'emoticon')
 GRAPHIC_ROOT = os.path.join(MEDIA_ROOT, 'graphic')
 
+# upper bounds for one batched fetch from /new?max=N and the websocket "new" request
+MAX_FETCH_COUNT = 1000
+MAX_FETCH_BYTES = 1024 * 1024
+
+# upper bound for the number of messages in one /send/batch request
+MAX_BATCH_COUNT = 5000
+
+# upper bound in seconds for a long-poll with /new?wait=N
+MAX_LONG_POLL = 60
+
+# str and unicode on python 2
+TEXT = (str, type(u''))
+
+# addresses allowed to read /metrics, unless "metrics_allow" is set in office.json
+METRICS_ALLOW = ['127.0.0.1', '::1', '::ffff:127.0.0.1']
+
 # auth
 # expects body
 #
@@ -52,7 +94,6 @@ def auth():
 
     if request.headers.get('Accepts', '').startswith('application/json'):
         response.set_cookie('token', token)
-        print({ "result": "ok", "token": token })
         return { "result": "ok", "token": token }
     else:
         return HTTPResponse(status=200, headers={'Set-Cookie': sessions.get_cookie_header(token)})
@@ -74,7 +115,7 @@ def _auth(auth_module, username, password):
 @telegram.get('/telegram/auth/check')
 def auth_check():
     username = sessions.validate(request.cookies.get('auth-token'))
-    print('Checked ' + str(request.cookies.get('auth-token')) + ' -> ' + str(username))
+    log.debug('Checked token -> %s', username, extra=logs.SAMPLED)
     if username is None:
         abort(401, "Invalid token")
     return HTTPResponse(status=200)
@@ -87,23 +128,50 @@ def new():
     if username is None:
         return HTTPError(401, "Invalid token")
 
+    if request.query.get('wait') is not None:
+        try:
+            wait = min(float(request.query.get('wait')), MAX_LONG_POLL)
+        except ValueError:
+            abort(400, "wait must be a number")
+        try:
+            post_office.wait(username, wait)
+        except LongPollLimit:
+            return HTTPError(429, "Too many concurrent long-polls")
+
+    if request.query.get('max') is not None:
+        messages = _fetch_many(username, request.query.get('max'), request.query.get('max_bytes'))
+        if not messages:
+            return HTTPResponse(status=204)
+        return HTTPResponse(json.dumps(messages), status=200,
+                            headers={'Content-Type': 'application/json'})
+
     next_message = post_office.fetch(username)
 
     if next_message is None:
-        print("No next message")
         return HTTPResponse(status=204)
     else:
         headers, body = next_message
-        print(headers)
-        print(body)
         return HTTPResponse(body, status=200, headers=headers)
 
 
+def _fetch_many(username, max_count, max_bytes=None):
+    """
+    Drain a batch of messages for a user, as a list of {"headers": ..., "body": ...} dicts.
+    """
+    try:
+        max_count = min(int(max_count or MAX_FETCH_COUNT), MAX_FETCH_COUNT)
+        max_bytes = min(int(max_bytes or MAX_FETCH_BYTES), MAX_FETCH_BYTES)
+    except ValueError:
+        abort(400, "max and max_bytes must be integers")
+    return [{'headers': headers, 'body': body} for headers, body
+            in post_office.fetch_many(username, max(max_count, 1), max_bytes)]
+
+
 @telegram.route('/socket')
 @telegram.route('/telegram/socket')
 def socket():
     username = sessions.validate(request.cookies.get('auth-token'))
-    print('User: %s' % username)
+    log.debug('Socket for %s', username)
     if username is None:
         abort(401, "Invalid token")
 
@@ -111,59 +179,207 @@ def socket():
     if not wsock:
         abort(400, "Websocket request expected")
 
-    def callback(headers, body):
-        wsock.send(json.dumps({
-            'status': 200,
-            'request': 'new',
-            'headers': headers,
-            'body': body
-        }))
-
-    post_office.listen(username, callback)
-
+    # ?framing=binary for compact, deflated frames; the web client sticks to JSON
+    try:
+        framing = get_framing(request.query.get('framing', 'json'))
+    except ValueError as e:
+        abort(400, str(e))
+
+    try:
+        connection = connections.open(username, wsock, framing)
+    except TooManySockets as e:
+        # 1013 is "try again later"; geventwebsocket's close() cannot send a code
+        wsock.send_frame(struct.pack('!H', 1013) + str(e).encode('utf-8'), wsock.OPCODE_CLOSE)
+        wsock.close()
+        return ''
+
+    handle = post_office.listen(username, connection.deliver)
+    connection.on_close.append(lambda: post_office.unlisten(handle))
+    # at-least-once: what the client has not acknowledged is delivered again
+    connection.on_close.append(
+        lambda: post_office.requeue(username, list(connection.unacked.values())))
+    try:
+        _serve_socket(username, connection)
+    finally:
+        connections.close(connection)
+    return ''
+
+
+def _serve_socket(username, connection):
+    wsock = connection.wsock
     while True:
         try:
             message = wsock.receive()
-            if message is not None:
-                print("Message: " + message)
-                message = json.loads(message)
-                address = message.get('request')
-                if address == 'new':
-                    while True:
-                        next_message = post_office.fetch(username)
-                        if next_message is None:
-                            wsock.send('{"status": 204}')
-                            break
-                        else:
-                            headers, body = next_message
-                            wsock.send(json.dumps({
-                                'status': 200,
-                                'request': 'new',
-                                'headers': headers,
-                                'body': body
-                            }))
-
-                elif address == 'proxy':
-                    headers = message.get('headers', {})
-                    body = message.get('body', '')
-                    headers['X-Telegram-From'] = username
-                    #try:
+            if message is None:
+                break
+            connection.touch()
+            try:
+                message = connection.framing.decode(message)
+            except ValueError:
+                message = None
+            if not isinstance(message, dict):
+                connection.send({'status': 400})
+                continue
+            address = message.get('request')
+            log.debug('Socket request "%s" from %s', address, username, extra=logs.SAMPLED)
+            if address == 'new':
+                try:
+                    max_count = min(int(message.get('max') or MAX_FETCH_COUNT), MAX_FETCH_COUNT)
+                except (ValueError, TypeError):
+                    connection.send({'status': 400})
+                    continue
+                if not _send_inbox(username, connection, max_count):
+                    connection.send({'status': 204})
+
+            elif address == 'ack':
+                message_ids = message.get('id', [])
+                if not isinstance(message_ids, list):
+                    message_ids = [message_ids]
+                if not all(isinstance(message_id, TEXT) for message_id in message_ids):
+                    connection.send({'status': 400})
+                    continue
+                connection.ack(message_ids)
+                if connection.behind:
+                    _send_inbox(username, connection)
+
+            elif address == 'proxy':
+                headers = message.get('headers', {})
+                body = message.get('body', '')
+                if not isinstance(headers, dict) or not isinstance(body, TEXT) or \
+                        not all(isinstance(key, TEXT) for key in headers):
+                    connection.send({'status': 400})
+                    continue
+                headers['X-Telegram-From'] = username
+                try:
                     post_office.post(headers, body, foreign=False)
-                    wsock.send(json.dumps({'status': 201,}))
-                    #except:
-                    #    wsock.send(json.dumps({'status': 404,}))
+                    connection.send({'status': 201,})
+                except (RateLimited, InboxFull) as e:
+                    connection.send({'status': 429, 'error': str(e)})
+                except Overloaded as e:
+                    connection.send({'status': 503, 'error': str(e)})
 
-                elif address == 'close':
-                    wsock.close()
-                    break
+            elif address == 'ping':
+                connection.send({'status': 200, 'request': 'pong'})
 
-                else:
-                    wsock.send('{"status": 404}')
+            elif address == 'pong':
+                pass  # answer to our ping, the touch above is all it takes
+
+            elif address == 'close':
+                wsock.close()
+                break
+
+            else:
+                connection.send({'status': 404})
         except WebSocketError:
-            print("WebSocketError")
+            log.info('Socket of %s failed', username)
             break
 
 
+def _send_inbox(username, connection, max_count=MAX_FETCH_COUNT):
+    """
+    Send messages from the inbox of a user over a socket, in frames of up to max_count
+    messages, for as long as the window of the connection allows.
+
+    :rtype: int The number of messages sent
+    """
+    connection.behind = False
+    sent = 0
+    while connection.free():
+        messages = _fetch_many(username, min(max_count, connection.free()))
+        if not messages:
+            return sent
+        connection.deliver_many(messages)
+        sent += len(messages)
+    connection.behind = True  # there may be more
+    return sent
+
+
+@telegram.get('/events')
+@telegram.get('/telegram/events')
+def events():
+    """
+    Stream the messages of a user as Server-Sent Events, each with its x-telegram-seq as
+    the event id. A client that reconnects with Last-Event-ID first gets the recent messages
+    it missed, as far as they are kept, then what is in the inbox, then new messages as
+    they arrive.
+    """
+    username = sessions.validate(request.cookies.get('auth-token'))
+    if username is None:
+        abort(401, "Invalid token")
+    try:
+        last_seq = int(request.headers.get('Last-Event-ID') or 0)
+    except ValueError:
+        abort(400, "Last-Event-ID must be an integer")
+    if last_seq > post_office.sequence(username):
+        # numbered by another worker process, or before a restart; start over
+        last_seq = 0
+
+    event_settings = post_office.settings.get('events', {})
+    heartbeat = event_settings.get('heartbeat', 15)
+    queue = Queue(event_settings.get('queue', 100))
+    behind = [False]
+
+    def callback(headers, body):
+        # once behind, keep declining until the inbox is drained, so that order is kept
+        if behind[0] or queue.full():
+            behind[0] = True
+            raise ListenerBusy(u'Event stream of %s is behind' % username)
+        queue.put_nowait((headers, body))
+
+    def stream():
+        # listen before draining the inbox, so that nothing slips in between
+        handle = post_office.listen(username, callback)
+        pending = deque()  # taken from the inbox or the queue, not yet sent
+        caught_up = set()  # x-telegram-id of the messages sent before going live
+        top = [last_seq]
+
+        def event(headers, body):
+            seq = int(headers.get('x-telegram-seq', 0))
+            lines = []
+            if seq > top[0]:  # without an id line the client keeps its last event id
+                top[0] = seq
+                lines.append('id: %i\n' % seq)
+            lines.append('data: %s\n\n' % json.dumps({'headers': headers, 'body': body}))
+            return ''.join(lines)
+
+        def drain():
+            pending.extend(post_office.fetch_many(username, MAX_FETCH_COUNT, MAX_FETCH_BYTES))
+            return bool(pending)
+
+        try:
+            yield 'retry: 5000\n\n'
+            if last_seq:
+                for headers, body in post_office.history(username, last_seq):
+                    caught_up.add(headers.get('x-telegram-id'))
+                    yield event(headers, body)
+            live = False
+            while True:
+                while pending:
+                    headers, body = pending[0]
+                    if headers.get('x-telegram-id') not in caught_up:
+                        if not live:
+                            caught_up.add(headers.get('x-telegram-id'))
+                        yield event(headers, body)
+                    pending.popleft()  # only once sent
+                if not live:
+                    live = not drain()
+                elif behind[0] and queue.empty():
+                    behind[0] = drain()
+                else:
+                    try:
+                        pending.append(queue.get(timeout=heartbeat))
+                    except Empty:
+                        yield ': ping\n\n'
+        finally:
+            post_office.unlisten(handle)
+            post_office.requeue(username, list(pending) + list(queue.queue))
+
+    response.content_type = 'text/event-stream'
+    response.set_header('Cache-Control', 'no-cache')
+    response.set_header('X-Accel-Buffering', 'no')  # keep nginx from buffering the stream
+    return stream()
+
+
 @telegram.post('/proxy')
 @telegram.post('/telegram/proxy')
 def proxy():
@@ -172,17 +388,58 @@ def proxy():
         abort(401, "Invalid token")
     headers = dict(request.headers)
     headers['X-Telegram-From'] = username
-    post_office.post(headers, request.body, foreign=False)
+    _post(headers, request.body.read().decode('utf-8'), foreign=False)
     return HTTPResponse(status=201)
 
 
 @telegram.post('/send')
 @telegram.post('/telegram/send')
 def send():
-    post_office.post(request.headers, request.body)
+    _post(dict(request.headers), request.body.read().decode('utf-8'), foreign=True)
     return HTTPResponse(status=201)
 
 
+def _post(headers, body, foreign):
+    """
+    Post a message, or answer 429 if the sender or the receiver is over its limit and 503
+    if the server is too busy.
+    """
+    try:
+        post_office.post(headers, body, foreign=foreign,
+                         peer=request.remote_addr if foreign else None)
+    except (RateLimited, InboxFull) as e:
+        raise HTTPError(429, str(e), Retry_After='1')
+    except Overloaded as e:
+        raise HTTPError(503, str(e), Retry_After='1')
+
+
+# send/batch
+# expects one signed message per line (application/x-ndjson), or a JSON array of them
+#
+# {"headers": {"X-Telegram-From": "USER@DOMAIN", ...}, "body": "BODY"}
+#
+# answers with one result per message, in order
+#
+# {"results": [{"status": 201}, {"status": 400, "error": "ERROR"}, ...]}
+@telegram.post('/send/batch')
+@telegram.post('/telegram/send/batch')
+def send_batch():
+    data = request.body.read().decode('utf-8')
+    try:
+        if request.content_type.startswith('application/json'):
+            items = json.loads(data)
+        else:
+            items = [json.loads(line) for line in data.splitlines() if line.strip()]
+        messages = [(item['headers'], item['body']) for item in items]
+    except (ValueError, KeyError, TypeError):
+        abort(400, "Malformed batch")
+
+    if len(messages) > MAX_BATCH_COUNT:
+        abort(413, "At most %i messages per batch" % MAX_BATCH_COUNT)
+
+    return {'results': post_office.post_many(messages, peer=request.remote_addr)}
+
+
 @telegram.get('/key')
 def key():
     """
@@ -215,6 +472,28 @@ def key_for_user(username):
         return HTTPResponse(status=200, body=key)
 
 
+@telegram.get('/metrics')
+def metrics_route():
+    """
+    Returns the metrics of this process in the Prometheus text exposition format.
+    """
+    if request.remote_addr not in post_office.settings.get('metrics_allow', METRICS_ALLOW):
+        abort(403, "Not allowed")
+    return HTTPResponse(metrics.REGISTRY.exposition(), status=200,
+                        headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+
+def collect_sessions():
+    stats = sessions.stats()
+    active = metrics.Gauge('telegram_sessions', 'Active sessions')
+    active.set(stats['sessions'])
+    events = metrics.Counter('telegram_sessions_total', 'Sessions created and ended',
+                             ['event'])
+    for event in ('created', 'expired', 'evicted'):
+        events.labels(event).inc(stats[event])
+    return [active, events]
+
+
 @telegram.get('/')
 @telegram.get('/web')
 def web():
@@ -285,7 +564,151 @@ def image_graphic(icon):
     return static_file(icon + '.png', GRAPHIC_ROOT)
 
 
+def setup():
+    global internal_auth, post_office, sessions, connections
+    post_office = PostOffice(config_dir)
+    internal_auth = InternalAuth(config_dir, directory=post_office.directory,
+                                 **post_office.settings.get('passwords', {}))
+    sessions = open_session_handler(post_office.settings.get('sessions', {}), config_dir)
+    connections = ConnectionManager(**post_office.settings.get('sockets', {}))
+    connections.start()
+    metrics.REGISTRY.register(post_office.collect)
+    metrics.REGISTRY.register(connections.collect)
+    metrics.REGISTRY.register(collect_sessions)
+
+    # an SQLite user directory is read on each lookup and needs no reloading
+    if post_office.directory is None:
+        watcher = FileWatcher(post_office.settings.get('reload_interval', 2))
+        watcher.watch(post_office.users_filename, post_office.reload_users)
+        watcher.watch(internal_auth.passwd_filename, internal_auth.reload)
+        watcher.start()
+
+
+def sweep_sessions():
+    while True:
+        gevent.sleep(sessions.sweep_interval)
+        swept = sessions.sweep()
+        if swept:
+            log.info('Swept %i expired sessions.', swept)
+
+
+def serve(listener):
+    """
+    Run the web server until it is stopped. SIGTERM stops accepting connections and waits
+    up to DRAIN_TIMEOUT seconds for open requests and sockets before closing them.
+    """
+    setup_logging()
+    setup()
+    gevent.spawn(sweep_sessions)
+    server = WSGIServer(listener, telegram, handler_class=WebSocketHandler)
+
+    def drain():
+        log.info('Draining web server %i.', os.getpid())
+        gevent.spawn(server.stop, timeout=DRAIN_TIMEOUT)
+    gevent.signal_handler(signal.SIGTERM, drain)
+
+    log.info("Starting web server %i.", os.getpid())
+    try:
+        server.serve_forever()
+    finally:
+        post_office.close()
+        logs.shutdown()
+
+
+def reuse_port_listener():
+    listener = sockets.socket(sockets.AF_INET, sockets.SOCK_STREAM)
+    listener.setsockopt(sockets.SOL_SOCKET, sockets.SO_REUSEADDR, 1)
+    listener.setsockopt(sockets.SOL_SOCKET, sockets.SO_REUSEPORT, 1)
+    listener.bind(('', PORT))
+    listener.listen(1024)
+    return listener
+
+
+def read_settings():
+    try:
+        with open(os.path.join(config_dir, 'office.json'), 'r') as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+
+def setup_logging(queued=True):
+    """
+    Configure logging from the "log" section of office.json, e.g. {"level": "info",
+    "json": false, "sample_rate": 0.01, "file": "telegram.log"}, and the --log-* flags.
+    """
+    settings = read_settings().get('log', {})
+    filename = args.log_file or settings.get('file')
+    logs.configure(level=args.log_level or settings.get('level', 'info'),
+                   json_format=args.log_json or settings.get('json', False),
+                   sample_rate=settings.get('sample_rate', 1.0),
+                   filename=os.path.join(config_dir, filename) if filename else None,
+                   queued=queued)
+
+
+def check_shared_backends():
+    """
+    Several workers need inboxes and sessions that all of them can see.
+    """
+    settings = read_settings()
+    if not settings.get('inbox', {}).get('shared', False):
+        exit('--workers needs "inbox": {"backend": "sqlite", "shared": true} in office.json')
+    if settings.get('sessions', {}).get('backend') != 'sqlite':
+        exit('--workers needs "sessions": {"backend": "sqlite"} in office.json')
+
+
+def supervise(workers):
+    """
+    Fork the worker processes, each with its own SO_REUSEPORT listener on the same port,
+    and restart the ones that die until SIGTERM or SIGINT, which is passed on to the
+    workers so that they drain.
+    """
+    check_shared_backends()
+    # the writer thread of a queued handler would not survive the forks
+    setup_logging(queued=False)
+    children = {}
+    """ @type: dict of [int, float] """
+    stopping = []
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                serve(reuse_port_listener())
+            finally:
+                os._exit(0)
+        children[pid] = time.time()
+
+    def stop(signum, frame):
+        log.info('Stopping %i workers.', len(children))
+        stopping.append(signum)
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for n in range(workers):
+        spawn()
+
+    while children:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            gevent.sleep(0.5)
+            continue
+        started = children.pop(pid, None)
+        if started is None or stopping:
+            continue
+        log.warning('Worker %i died (status %i), restarting.', pid, status)
+        if time.time() - started < 1:
+            gevent.sleep(1)  # do not spin on a worker that crashes on startup
+        spawn()
+
+
 debug(True)
-server = WSGIServer(('', 8080), telegram, handler_class=WebSocketHandler)
-print("Starting web server.")
-server.serve_forever()
+if args.workers > 1:
+    supervise(args.workers)
+else:
+    serve(('', PORT))
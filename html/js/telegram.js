@@ -1,18 +1,39 @@
 var ws = new WebSocket("ws://" + document.location.host + "/socket");
+var seen = {};  // x-telegram-id of the messages shown, as they may come again
 ws.onopen = function() {
-    ws.send(JSON.stringify({request: "new"}));
+    ws.send(JSON.stringify({request: "new", max: 100}));
 };
 ws.onmessage = function (evt) {
     var
         data = JSON.parse(evt.data);
 
-    if (data.request == 'new' && data.status == 200) {
+    if (data.request == 'ping') {
+        // the server closes sockets that stay silent
+        ws.send('{"request":"pong"}');
+    } else if (data.request == 'new' && data.status == 200) {
         var
-            sender = data.headers['x-telegram-from'],
-            receiver = data.headers['x-telegram-to'],
-            body = data.body;
-
-        print_message(sender, receiver, body);
+            messages = data.messages || [data],
+            ids = [];
+
+        for (var i = 0; i < messages.length; i++) {
+            var
+                id = messages[i].headers['x-telegram-id'],
+                sender = messages[i].headers['x-telegram-from'],
+                receiver = messages[i].headers['x-telegram-to'],
+                body = messages[i].body;
+
+            if (id) {
+                ids.push(id);
+                if (seen[id]) {
+                    continue;
+                }
+                seen[id] = true;
+            }
+            print_message(sender, receiver, body);
+        }
+        if (ids.length) {
+            ws.send(JSON.stringify({request: "ack", id: ids}));
+        }
     }
 };
 ws.onclose = function (evt) {
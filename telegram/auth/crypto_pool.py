@@ -0,0 +1,157 @@
+from __future__ import print_function
+import fcntl
+import os
+import pickle
+import socket
+import struct
+from gevent.queue import Queue
+from telegram.auth.sign import KeyCache, sign_text, verify_text
+
+
+class CryptoPool(object):
+    def __init__(self, workers):
+        """
+        Runs RSA signing and verification in forked worker processes, so that bursts of
+        messages do not stall the gevent loop of the server.
+
+        Each worker talks to the server over its own socket pair and keeps its own cache of
+        imported keys. A caller waits cooperatively for an idle worker and for its answer.
+
+        :param int workers: The number of worker processes
+        """
+        self.workers = workers
+        self.calls = 0
+        self._idle = Queue()
+        self._channels = set()
+        for n in range(workers):
+            self._spawn()
+
+    def sign(self, sender, private_key, text):
+        """
+        Sign a text with a private key in a worker process.
+
+        :rtype: unicode The signature, base64 encoded
+        """
+        return self._call(('sign', sender, private_key, text))
+
+    def verify(self, sender, public_key, signature, text):
+        """
+        Verify the signature of a text with a public key in a worker process.
+
+        :rtype: bool True if authentic, False otherwise
+        """
+        return self._call(('verify', sender, public_key, signature, text))
+
+    def close(self):
+        """
+        Stop all worker processes.
+        """
+        for channel in self._channels:
+            channel.close()
+        for channel in self._channels:
+            os.waitpid(channel.pid, 0)
+        self._channels.clear()
+
+    def _spawn(self):
+        parent, child = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            # the worker stays off the gevent loop inherited from the server and uses plain
+            # blocking reads and writes on its end of the socket pair
+            parent.close()
+            for channel in self._channels:
+                channel.close()
+            try:
+                _serve(child.fileno())
+            finally:
+                os._exit(0)
+        child.close()
+        channel = _Channel(parent, pid)
+        self._channels.add(channel)
+        self._idle.put(channel)
+
+    def _call(self, request):
+        channel = self._idle.get()
+        self.calls += 1
+        try:
+            reply = channel.call(request)
+        except (IOError, EOFError) as e:
+            channel.close()
+            os.waitpid(channel.pid, os.WNOHANG)
+            self._channels.discard(channel)
+            self._spawn()
+            raise IOError('Crypto worker %i failed: %s' % (channel.pid, str(e)))
+        self._idle.put(channel)
+
+        ok, value = reply
+        if not ok:
+            raise ValueError(value)
+        return value
+
+
+class _Channel(object):
+    def __init__(self, sock, pid):
+        self.sock = sock
+        self.pid = pid
+
+    def call(self, request):
+        _write_frame(self.sock.sendall, request)
+        reply = _read_frame(self.sock.recv)
+        if reply is None:
+            raise EOFError('Worker closed the connection')
+        return reply
+
+    def close(self):
+        self.sock.close()
+
+
+def _serve(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+
+    def write(data):
+        while data:
+            data = data[os.write(fd, data):]
+
+    def read(size):
+        return os.read(fd, size)
+
+    cache = KeyCache()
+    while True:
+        request = _read_frame(read)
+        if request is None:
+            return
+        try:
+            if request[0] == 'sign':
+                reply = (True, sign_text(cache, *request[1:]))
+            else:
+                reply = (True, verify_text(cache, *request[1:]))
+        except Exception as e:
+            reply = (False, str(e))
+        _write_frame(write, reply)
+
+
+def _write_frame(write, value):
+    data = pickle.dumps(value, 2)
+    write(struct.pack('!I', len(data)) + data)
+
+
+def _read_frame(read):
+    header = _read_exactly(read, 4)
+    if header is None:
+        return None
+    data = _read_exactly(read, struct.unpack('!I', header)[0])
+    if data is None:
+        return None
+    return pickle.loads(data)
+
+
+def _read_exactly(read, size):
+    chunks = []
+    while size:
+        chunk = read(min(size, 65536))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
@@ -1,36 +1,116 @@
+import hashlib
+import hmac
 import os
-from Crypto.Hash import SHA512
+import time
+from gevent.threadpool import ThreadPool
+from telegram.auth.passwords import (DEFAULT_SCHEME, hash_password, verify_password,
+                                     needs_rehash)
+from telegram.directory import read_passwd, update_passwd
+from telegram.log import get_logger
 
-
-def hashpass(password):
-    password = bytes(password)
-    hash = SHA512.new(password)
-    return hash.hexdigest()
+log = get_logger(__name__)
 
 
 class InternalAuth(object):
-    def __init__(self, config_dir=None):
+    def __init__(self, config_dir=None, scheme=DEFAULT_SCHEME, cost=None, cache_ttl=60,
+                 threads=4, directory=None):
+        """
+        Password authentication against the passwd file.
+
+        Hashes are computed on a thread pool, off the gevent loop. Stored hashes in another
+        scheme or cost, including unsalted SHA512 ones, are replaced on the next successful
+        login. A successful login is remembered for cache_ttl seconds, so that repeated
+        logins with the same password skip the hashing.
+
+        :param str scheme: Password hash scheme for new hashes, see telegram.auth.passwords
+        :param int cost: Cost of new hashes
+        :param int cache_ttl: Seconds to remember a verified password
+        :param int threads: Number of hashing threads
+        :param SQLiteDirectory directory: Keep the hashes in this user directory instead of
+                                          the passwd file
+        """
         self._users = {}
+        self.directory = directory
+        self.scheme = scheme
+        self.cost = cost
+        self.cache_ttl = cache_ttl
+        self.passwd_filename = None
+        self._threads = ThreadPool(threads)
+        self._verified = {}
+        """ @type: dict of [str, tuple of [bytes, float, str]] """
+        self._cache_key = os.urandom(32)
+        self._dummy = hash_password(u'', scheme, cost)
         if config_dir is not None:
             self.load_config(config_dir)
 
     def load_config(self, config_dir):
-        self.passwd_filename = os.path.join(config_dir, 'passwd')
-        with open(self.passwd_filename, 'r') as f:
-            for l in f.readlines():
-                user, password = l.strip().split(':', 1)
-                self._users[user] = password
-                print("Added internal authentication for user %s." % user)
+        if self.directory is None:
+            self.passwd_filename = os.path.join(config_dir, 'passwd')
+            self.reload()
+
+    def reload(self):
+        """
+        Read the passwd file again and swap in its users and hashes. Remembered logins of
+        users whose hash changed or who were removed are forgotten.
+        """
+        users = read_passwd(self.passwd_filename)
+
+        for user in users:
+            if user not in self._users:
+                log.info("Added internal authentication for user %s.", user)
+        for user in self._users:
+            if user not in users:
+                log.info("Removed internal authentication for user %s.", user)
+            if users.get(user) != self._users[user]:
+                self._verified.pop(user, None)
+        self._users = users
 
     def add_user(self, username, password):
-        if username in self._users:
+        if self._get_hash(username) is not None:
             raise NameError(u'User "%s" already exists.' % username)
-        self._users[username] = hashpass(password)
+        stored = self._threads.apply(hash_password, (password, self.scheme, self.cost))
+        if self.directory is not None:
+            self.directory.set_password(username, stored)
+        else:
+            self._users[username] = stored
 
     def authenticate(self, username, password):
-        try:
-            if self._users[username] == hashpass(password):
-                return True
-        except KeyError:
-            pass
-        return False
+        if password is None:
+            return False
+        stored = self._get_hash(username)
+        if stored is None:
+            # spend the same time as for a real user
+            self._threads.apply(verify_password, (password, self._dummy))
+            return False
+
+        now = time.time()
+        if not isinstance(password, bytes):
+            password = password.encode('utf-8')
+        fingerprint = hmac.new(self._cache_key, password, hashlib.sha256).digest()
+        cached = self._verified.get(username)
+        if cached is not None and cached[1] > now and cached[2] == stored\
+                and hmac.compare_digest(cached[0], fingerprint):
+            return True
+
+        if not self._threads.apply(verify_password, (password, stored)):
+            return False
+
+        if needs_rehash(stored, self.scheme, self.cost):
+            stored = self._threads.apply(hash_password, (password, self.scheme, self.cost))
+            if self.directory is not None:
+                self.directory.set_password(username, stored)
+                log.info("Upgraded the password hash of user %s.", username)
+            else:
+                self._users[username] = stored
+                if self.passwd_filename is not None:
+                    # only this line, the file may have changed since it was read
+                    update_passwd(self.passwd_filename, {username: stored})
+                    log.info("Upgraded the password hash of user %s.", username)
+
+        self._verified[username] = (fingerprint, now + self.cache_ttl, stored)
+        return True
+
+    def _get_hash(self, username):
+        if self.directory is not None:
+            return self.directory.get_password(username)
+        return self._users.get(username)
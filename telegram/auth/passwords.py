@@ -0,0 +1,75 @@
+import binascii
+import hashlib
+import hmac
+import os
+
+DEFAULT_SCHEME = 'pbkdf2_sha256'
+DEFAULT_COST = {
+    'pbkdf2_sha256': 200000,  # iterations
+    'scrypt': 2 ** 14,  # n
+}
+
+
+def hash_password(password, scheme=DEFAULT_SCHEME, cost=None):
+    """
+    Hash a password with a random salt, for storing in the passwd file.
+
+    :param unicode password: The password
+    :param str scheme: "pbkdf2_sha256" or "scrypt"
+    :param int cost: Iterations for pbkdf2_sha256, n for scrypt (default from DEFAULT_COST)
+    :rtype: str "scheme$cost$salt$hash"
+    """
+    cost = cost or DEFAULT_COST.get(scheme)
+    salt = os.urandom(16)
+    return '%s$%i$%s$%s' % (scheme, cost, _hex(salt), _hex(_derive(password, scheme, cost, salt)))
+
+
+def verify_password(password, stored):
+    """
+    Check a password against a stored hash in constant time. Besides the salted formats of
+    hash_password, unsalted SHA512 hex digests from older passwd files are accepted.
+
+    :param unicode password: The password
+    :param str stored: The stored hash
+    :rtype: bool True if the password matches
+    """
+    if '$' not in stored:
+        digest = hashlib.sha512(_bytes(password)).hexdigest()
+        return hmac.compare_digest(digest, stored.lower())
+    try:
+        scheme, cost, salt, digest = stored.split('$')
+        expected = _derive(password, scheme, int(cost), binascii.unhexlify(salt))
+    except ValueError:
+        return False
+    return hmac.compare_digest(_hex(expected), digest)
+
+
+def needs_rehash(stored, scheme=DEFAULT_SCHEME, cost=None):
+    """
+    Tell if a stored hash is weaker than, or just different from, what hash_password would
+    make with the given scheme and cost.
+
+    :param str stored: The stored hash
+    :rtype: bool
+    """
+    cost = cost or DEFAULT_COST.get(scheme)
+    parts = stored.split('$')
+    return len(parts) != 4 or parts[0] != scheme or parts[1] != str(cost)
+
+
+def _derive(password, scheme, cost, salt):
+    if scheme == 'pbkdf2_sha256':
+        return hashlib.pbkdf2_hmac('sha256', _bytes(password), salt, cost)
+    elif scheme == 'scrypt' and hasattr(hashlib, 'scrypt'):
+        return hashlib.scrypt(_bytes(password), salt=salt, n=cost, r=8, p=1)
+    raise ValueError('Unsupported password scheme "%s"' % str(scheme))
+
+
+def _bytes(text):
+    if isinstance(text, bytes):
+        return text
+    return text.encode('utf-8')
+
+
+def _hex(data):
+    return binascii.hexlify(data).decode('ascii')
@@ -1,26 +1,87 @@
 from __future__ import print_function
 
+import heapq
+import os
 import random
 import string
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from telegram import db
+from telegram.log import get_logger
+
+log = get_logger(__name__)
+
+
+def open_session_handler(settings, config_dir):
+    """
+    Create the session handler described by the "sessions" section of office.json.
+
+    :param dict settings: The session settings, e.g. {"backend": "sqlite", "expiry": 3600}
+    :param str config_dir: Directory that relative paths are resolved against
+    :rtype: SessionHandler
+    """
+    settings = dict(settings)
+    backend = settings.pop('backend', 'memory')
+    if backend == 'memory':
+        return SessionHandler(**settings)
+    elif backend == 'sqlite':
+        filename = os.path.join(config_dir, settings.pop('path', 'sessions.db'))
+        return SQLiteSessionHandler(filename, **settings)
+    else:
+        raise ValueError('Unknown session backend "%s"' % str(backend))
 
 
 def generate_token(length):
-    pool = string.letters + string.digits
-    return ''.join(random.choice(pool) for i in xrange(length))
+    pool = string.ascii_letters + string.digits
+    return ''.join(random.choice(pool) for i in range(length))
 
 
 
 class SessionHandler(object):
-    def __init__(self, expiry=3600):
+    def __init__(self, expiry=3600, sliding=True, max_per_user=16, sweep_interval=60):
+        """
+        Keeps the session tokens of logged in users.
+
+        Tokens expire after expiry seconds, counted from the last use if sliding is set.
+        Expired tokens are found through a heap ordered by expiry, by sweep(), which should
+        be called every sweep_interval seconds and is also called on create(). A user can have
+        at most max_per_user sessions; the oldest one is dropped to make room for a new one.
+
+        :param int expiry: Seconds until a session expires
+        :param bool sliding: Extend a session each time it is used
+        :param int max_per_user: The maximum number of sessions per user
+        :param int sweep_interval: Recommended seconds between calls to sweep()
+        """
         self._sessions = {}
+        """ @type: dict of [str, tuple of [str, datetime]] """
+        self._user_sessions = {}
+        """ @type: dict of [str, OrderedDict of [str, None]] """
+        self._expiries = []
+        """ @type: list of [tuple of [datetime, str]] """
         self._expiry = timedelta(seconds=expiry)
+        self.sliding = sliding
+        self.max_per_user = max_per_user
+        self.sweep_interval = sweep_interval
+        self.created = 0
+        self.expired = 0
+        self.evicted = 0
 
     def create(self, user):
+        self.sweep()
         token = generate_token(64)
         expiry = datetime.now() + self._expiry
         self._sessions[token] = (user, expiry)
-        print('Created token %s -> %s' % (token, user))
+        heapq.heappush(self._expiries, (expiry, token))
+
+        user_sessions = self._user_sessions.setdefault(user, OrderedDict())
+        user_sessions[token] = None
+        while len(user_sessions) > self.max_per_user:
+            self.kill(next(iter(user_sessions)))
+            self.evicted += 1
+
+        self.created += 1
+        log.info('Created session for %s', user)
         return token
 
     def get_cookie_header(self, token):
@@ -33,13 +94,138 @@ class SessionHandler(object):
             return None
         try:
             (user, expiry) = self._sessions[token]
-            return user
         except KeyError:
             return None
 
+        now = datetime.now()
+        if expiry <= now:
+            self.kill(token)
+            self.expired += 1
+            return None
+        if self.sliding:
+            # the heap keeps the old expiry; sweep() moves the entry when it comes up
+            self._sessions[token] = (user, now + self._expiry)
+        return user
+
     def kill(self, token):
         try:
-            del self._sessions[token]
+            (user, expiry) = self._sessions.pop(token)
         except KeyError:
-            pass
-        
+            return
+        user_sessions = self._user_sessions[user]
+        del user_sessions[token]
+        if not user_sessions:
+            del self._user_sessions[user]
+
+    def sweep(self):
+        """
+        Drop all expired sessions.
+
+        :rtype: int The number of dropped sessions
+        """
+        now = datetime.now()
+        swept = 0
+        while self._expiries and self._expiries[0][0] <= now:
+            expiry, token = heapq.heappop(self._expiries)
+            session = self._sessions.get(token)
+            if session is None:
+                continue  # killed already
+            elif session[1] > now:
+                heapq.heappush(self._expiries, (session[1], token))
+            else:
+                self.kill(token)
+                swept += 1
+        self.expired += swept
+        return swept
+
+    def stats(self):
+        return {
+            'sessions': len(self._sessions),
+            'users': len(self._user_sessions),
+            'created': self.created,
+            'expired': self.expired,
+            'evicted': self.evicted,
+        }
+
+
+class SQLiteSessionHandler(SessionHandler):
+    def __init__(self, filename, expiry=3600, sliding=True, max_per_user=16, sweep_interval=60):
+        """
+        Keeps the session tokens in an SQLite database, so that several server processes
+        share them and they survive a restart. A sliding expiry is only written back when it
+        moves by at least a tenth of the expiry time.
+
+        :param str filename: The database file
+        """
+        super(SQLiteSessionHandler, self).__init__(expiry, sliding, max_per_user,
+                                                   sweep_interval)
+        self._seconds = self._expiry.total_seconds()
+        self._db = db.connect(filename)
+        db.execute(self._db, 'PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS sessions ('
+                         'token TEXT PRIMARY KEY, '
+                         'user TEXT NOT NULL, '
+                         'created REAL NOT NULL, '
+                         'expiry REAL NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS sessions_expiry ON sessions (expiry)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS sessions_user ON sessions (user, created)')
+
+    def create(self, user):
+        token = generate_token(64)
+        now = time.time()
+        db.execute(self._db, 'INSERT INTO sessions (token, user, created, expiry) '
+                   'VALUES (?, ?, ?, ?)', (token, user, now, now + self._seconds))
+        evicted = db.execute(self._db, 'DELETE FROM sessions WHERE token IN ('
+                             'SELECT token FROM sessions WHERE user = ? '
+                             'ORDER BY created DESC LIMIT -1 OFFSET ?)',
+                             (user, self.max_per_user)).rowcount
+        self.evicted += max(evicted, 0)
+        self.created += 1
+        log.info('Created session for %s', user)
+        return token
+
+    def get_cookie_header(self, token):
+        expiry, = self._db.execute('SELECT expiry FROM sessions WHERE token = ?',
+                                   (token,)).fetchone()
+        expiry = datetime.fromtimestamp(expiry)
+        return u'auth-token=%s; Expires=%s' % (token, expiry.strftime('%a, %d-%b-%Y %H:%M:%S %Z'))
+
+    def validate(self, token):
+        if token is None:
+            return None
+        row = self._db.execute('SELECT user, expiry FROM sessions WHERE token = ?',
+                               (token,)).fetchone()
+        if row is None:
+            return None
+
+        user, expiry = row
+        now = time.time()
+        if expiry <= now:
+            self.kill(token)
+            self.expired += 1
+            return None
+        if self.sliding and now + self._seconds - expiry >= self._seconds / 10:
+            db.execute(self._db, 'UPDATE sessions SET expiry = ? WHERE token = ?',
+                       (now + self._seconds, token))
+        return user
+
+    def kill(self, token):
+        db.execute(self._db, 'DELETE FROM sessions WHERE token = ?', (token,))
+
+    def sweep(self):
+        swept = db.execute(self._db, 'DELETE FROM sessions WHERE expiry <= ?',
+                           (time.time(),)).rowcount
+        self.expired += swept
+        return swept
+
+    def stats(self):
+        sessions, users = self._db.execute('SELECT COUNT(*), COUNT(DISTINCT user) '
+                                           'FROM sessions').fetchone()
+        return {
+            'sessions': sessions,
+            'users': users,
+            'created': self.created,
+            'expired': self.expired,
+            'evicted': self.evicted,
+        }
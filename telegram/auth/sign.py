@@ -1,6 +1,17 @@
+import base64
+import hashlib
+from collections import OrderedDict
 from Crypto.Signature import PKCS1_v1_5
 from Crypto.Hash import SHA
 from Crypto.PublicKey import RSA
+from telegram import metrics
+from telegram.log import get_logger
+
+log = get_logger(__name__)
+
+CRYPTO_SECONDS = metrics.histogram('telegram_crypto_seconds',
+                                   'Time to sign or verify a message', ['operation'])
+
 
 def generate_key_pair(username):
     private_key = RSA.generate(2048)
@@ -8,45 +19,153 @@ def generate_key_pair(username):
     return private_key.exportKey(), public_key.exportKey()
 
 
+def fingerprint(key):
+    """
+    A short digest identifying a PEM encoded key.
+
+    :param unicode key: The key PEM/PER encoded as a string
+    :rtype: str
+    """
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return hashlib.sha1(key).hexdigest()
+
+
+def digest(text):
+    """
+    The SHA-1 hash object of a text to sign or verify, UTF-8 encoded.
+
+    :param unicode text: The content
+    """
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    return SHA.new(text)
+
+
+def sign_text(cache, sender, private_key, text):
+    """
+    Sign a text with a private key.
+
+    :param KeyCache cache: Cache for the imported key
+    :param unicode sender: The owner of the key "username[@domain]"
+    :param unicode private_key: The key PEM/PER encoded as a string
+    :param unicode text: The content to sign
+    :rtype: unicode The signature, base64 encoded
+    """
+    signer = cache.get(sender, private_key)
+    return base64.b64encode(signer.sign(digest(text))).decode('ascii')
+
+
+def verify_text(cache, sender, public_key, signature, text):
+    """
+    Verify the signature of a text with a public key.
+
+    :param KeyCache cache: Cache for the imported key
+    :param unicode sender: The owner of the key "username[@domain]"
+    :param unicode public_key: The key PEM/PER encoded as a string
+    :param unicode signature: The signature, base64 encoded
+    :param unicode text: The signed content
+    :rtype: bool True if authentic, False otherwise
+    """
+    verifier = cache.get(sender, public_key)
+    return verifier.verify(digest(text), base64.b64decode(signature))
+
+
+class KeyCache(object):
+    def __init__(self, size=1024):
+        """
+        LRU cache of imported RSA keys, wrapped in PKCS1_v1_5 contexts, keyed by username
+        and key fingerprint so that a key is only parsed the first time it is used.
+
+        :param int size: The maximum number of keys to keep
+        """
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._contexts = OrderedDict()
+
+    def get(self, username, key):
+        """
+        Get the PKCS1_v1_5 context for a key, importing the key if it is not cached.
+
+        :param unicode username: The owner of the key "username[@domain]"
+        :param unicode key: The key PEM/PER encoded as a string
+        """
+        cache_key = (username, fingerprint(key))
+        try:
+            context = self._contexts.pop(cache_key)
+            self.hits += 1
+        except KeyError:
+            context = PKCS1_v1_5.new(RSA.importKey(key))
+            self.misses += 1
+            if len(self._contexts) >= self.size:
+                self._contexts.popitem(last=False)
+        self._contexts[cache_key] = context
+        return context
+
+    def invalidate(self, username=None):
+        """
+        Drop the cached keys of one user, or of all users.
+
+        :param unicode username: The user whose keys to drop, None for everyone
+        """
+        if username is None:
+            self._contexts.clear()
+        else:
+            for cache_key in [k for k in self._contexts if k[0] == username]:
+                del self._contexts[cache_key]
+
+    def stats(self):
+        return {'size': len(self._contexts), 'hits': self.hits, 'misses': self.misses}
+
+
 class RSAVerifier(object):
-    def __init__(self, public_key_getter):
+    def __init__(self, public_key_getter, cache=None):
         """
         Contructor for RSA Veriefier.
 
         :param function public_key_getter: A function that take the username and returns it's
                                     public key
+        :param KeyCache cache: Cache for the imported keys
         """
         self.public_key_getter = public_key_getter
+        self.cache = cache or KeyCache()
+        self.executor = None
+        """ @type: telegram.auth.crypto_pool.CryptoPool """
 
     def verify(self, sender, signature, text):
         """
         Verify a signed message.
 
         :param unicode sender: The sender of the message "username[@domain]"
-        :param unicode signature: The message's signature
+        :param unicode signature: The message's signature, base64 encoded
         :param unicode text: The signed content
         :rtype: bool True if authentic, False otherwise
         """
         public_key = self.public_key_getter(sender)
         if public_key is None:
-            print("Unable to find the public key for %s!" % sender)
+            log.warning("Unable to find the public key for %s!", sender)
             return False
 
-        key = RSA.importKey(public_key)
-        h = SHA.new(text)
-        verifier = PKCS1_v1_5.new(key)
-        return verifier.verify(h, signature)
+        with CRYPTO_SECONDS.labels('verify').time():
+            if self.executor is not None:
+                return self.executor.verify(sender, public_key, signature, text)
+            return verify_text(self.cache, sender, public_key, signature, text)
 
 
 class RSASigner(object):
-    def __init__(self, private_key_getter):
+    def __init__(self, private_key_getter, cache=None):
         """
         Contructor for RSA Veriefier.
 
         :param function private_key_getter: A function that take the username and returns 
                                     it's private key
+        :param KeyCache cache: Cache for the imported keys
         """
         self.private_key_getter = private_key_getter
+        self.cache = cache or KeyCache()
+        self.executor = None
+        """ @type: telegram.auth.crypto_pool.CryptoPool """
 
     def sign(self, sender, text):
         """
@@ -54,14 +173,14 @@ class RSASigner(object):
 
         :param unicode sender: The sender of the message "username[@domain]"
         :param unicode text: The content tot sign
-        :rtype: unicode The signature
+        :rtype: unicode The signature, base64 encoded
         """
-        private_key = self.private_key_getter
+        private_key = self.private_key_getter(sender)
         if private_key is None:
-            print("Unable to find the private key for %s!" % sender)
+            log.warning("Unable to find the private key for %s!", sender)
             return None
 
-        key = RSA.importKey(private_key)
-        h = SHA.new(text)
-        signer = PKCS1_v1_5.new(key)
-        return signer.sign(h)
+        with CRYPTO_SECONDS.labels('sign').time():
+            if self.executor is not None:
+                return self.executor.sign(sender, private_key, text)
+            return sign_text(self.cache, sender, private_key, text)
@@ -3,7 +3,9 @@ import json
 import requests
 import time
 import threading
+from collections import deque
 
+from telegram.framing import get_framing
 from telegram.post import Message
 
 
@@ -21,6 +23,8 @@ class TelegramClient(object):
         self.protocol = 'http'
         self.port = 8080
         self.polling = True
+        self.batch_size = 100
+        self.long_poll = 30
 
         # Callbacks
         self.on_token_change_callback = None
@@ -48,7 +52,9 @@ class TelegramClient(object):
 
     @property
     def recommended_wait(self):
-        if self._no_mail_today <= 10:
+        if self.long_poll and self._no_mail_today == 0:
+            return 0
+        elif self._no_mail_today <= 10:
             return 1
         else:
             return min(180, (self._no_mail_today - 10) * 5)
@@ -122,6 +128,8 @@ class TelegramClient(object):
 
         response = self._session.get(
             '%s://%s:%i/new' % (self.protocol, self.domain, self.port),
+            params={'max': self.batch_size, 'wait': self.long_poll},
+            timeout=self.long_poll + 10,
         )
 
         if response.status_code == 401:
@@ -132,14 +140,15 @@ class TelegramClient(object):
         
         if response.status_code == 200 and callable(self.on_message_callback):
             self._no_mail_today = 0
-            self.on_message_callback(
-                Message(
-                    response.headers, 
-                    response.content.decode('utf-8'),
-                    response.status_code
+            for message in response.json():
+                self.on_message_callback(
+                    Message(
+                        message.get('headers'),
+                        message.get('body'),
+                        response.status_code
+                    )
                 )
-            )
-        else:
+        elif response.status_code != 204 or not self.long_poll:
             self._no_mail_today += 1
 
     def close(self):
@@ -153,12 +162,17 @@ class TelegramSocket(TelegramClient):
         self.protocol = 'ws'
         self.keep_open = False
         self.polling = False
+        self.framing = get_framing('binary')
+        # x-telegram-id of recent messages, as an unacknowledged message may come again
+        self._seen = set()
+        self._seen_order = deque()
         
     def connect(self):
         import websocket
         protocol = 'ws' if self.protocol == 'http' else 'wss'
         self.ws = websocket.WebSocketApp(
-            '%s://%s:%i/socket' % (protocol, self.domain, self.port),
+            '%s://%s:%i/socket?framing=%s' % (protocol, self.domain, self.port,
+                                              self.framing.name),
             on_message=self.on_message,
             on_error=self.on_error,
             on_close=self.on_close,
@@ -172,7 +186,7 @@ class TelegramSocket(TelegramClient):
         print("Client: WS: Opening")
         self.keep_open = True
         def run():
-            ws.send(json.dumps({'request': 'new'}))
+            self._send_frame(ws, {'request': 'new', 'max': self.batch_size})
             while(self.keep_open):
                 time.sleep(.1)
             time.sleep(.1)
@@ -182,14 +196,38 @@ class TelegramSocket(TelegramClient):
 
     def on_message(self, ws, message):
         print(message)
-        if callable(self.on_message_callback):
-            data = json.loads(message)
-            if data.get('request') == 'new' and data.get('status') == 200:
-                self.on_message_callback(Message(
-                    data.get('headers'),
-                    data.get('body'),
-                    data.get('status')
-                ))
+        # a server without binary framing answers in JSON, which decode() takes as well
+        data = self.framing.decode(message)
+        if data.get('request') == 'ping':
+            # the server closes sockets that stay silent
+            self._send_frame(ws, {'request': 'pong'})
+        elif data.get('request') == 'new' and data.get('status') == 200:
+            messages = data.get('messages', [data])
+            if callable(self.on_message_callback):
+                for item in messages:
+                    if self._seen_before(item.get('headers', {}).get('x-telegram-id')):
+                        continue
+                    self.on_message_callback(Message(
+                        item.get('headers'),
+                        item.get('body'),
+                        data.get('status')
+                    ))
+            # unacknowledged messages are delivered again, possibly over another socket
+            message_ids = [item['headers']['x-telegram-id'] for item in messages
+                           if 'x-telegram-id' in item.get('headers', {})]
+            if message_ids:
+                self._send_frame(ws, {'request': 'ack', 'id': message_ids})
+
+    def _seen_before(self, message_id):
+        if message_id is None:
+            return False
+        if message_id in self._seen:
+            return True
+        self._seen.add(message_id)
+        self._seen_order.append(message_id)
+        if len(self._seen_order) > 10000:
+            self._seen.discard(self._seen_order.popleft())
+        return False
 
     def on_error(self, ws, error):
         print("Client: WS: Error: " + error)
@@ -207,10 +245,17 @@ class TelegramSocket(TelegramClient):
                 },
                 'body': message
             }
-            self.ws.send(json.dumps(data))
+            self._send_frame(self.ws, data)
         except Exception as e:
             raise SendError(str(e))
 
+    def _send_frame(self, ws, frame):
+        import websocket
+        if self.framing.name == 'binary':
+            ws.send(self.framing.encode(frame), opcode=websocket.ABNF.OPCODE_BINARY)
+        else:
+            ws.send(self.framing.encode(frame))
+
     # override
     def recieve(self, *args, **kwargs):
         pass
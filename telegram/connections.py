@@ -0,0 +1,260 @@
+from __future__ import print_function
+import time
+import uuid
+from collections import OrderedDict
+import gevent
+from gevent.lock import Semaphore
+from telegram import metrics
+from telegram.post.listeners import ListenerBusy
+from telegram.log import get_logger
+
+log = get_logger(__name__)
+
+
+class TooManySockets(Exception):
+    pass
+
+
+class Connection(object):
+    def __init__(self, username, wsock, framing, window=100):
+        """
+        An open websocket of a user. Frames are sent one at a time, whichever greenlet sends
+        them.
+
+        Messages are kept until the client acknowledges them by their x-telegram-id, so
+        that the unacknowledged ones can be put back in the inbox when the socket goes away.
+        At most window messages are waiting for acknowledgement at a time.
+
+        :param str username: The owner of the socket
+        :param geventwebsocket.websocket.WebSocket wsock: The websocket
+        :param telegram.framing.JSONFraming|BinaryFraming framing: The framing for the socket
+        :param int window: The maximum number of unacknowledged messages
+        """
+        self.username = username
+        self.wsock = wsock
+        self.framing = framing
+        self.last_seen = time.time()
+        self.greenlet = gevent.getcurrent()
+        self.on_close = []
+        """ @type: list of [function] called when the connection is closed """
+        self.closed = False
+        self.window = window
+        self.unacked = OrderedDict()
+        """ @type: OrderedDict of [str, tuple of [dict, str]] """
+        self.behind = False
+        """ @type: bool True if a message was declined because the window was full """
+        self._sending = Semaphore()
+
+    def touch(self):
+        self.last_seen = time.time()
+
+    def send(self, frame):
+        """
+        :param dict frame: The frame, e.g. {"status": 200, "request": "new", ...}
+        """
+        with self._sending:
+            self.wsock.send(self.framing.encode(frame))
+
+    def free(self):
+        """
+        :rtype: int The number of messages that can be sent before the window is full
+        """
+        return max(self.window - len(self.unacked), 0)
+
+    def deliver(self, headers, body):
+        """
+        Send a message as a listener.
+
+        :raises ListenerBusy: If the window is full
+        """
+        if not self.free():
+            self.behind = True
+            raise ListenerBusy(u'Too many unacknowledged messages for %s' % self.username)
+        self.send({
+            'status': 200,
+            'request': 'new',
+            'headers': headers,
+            'body': body
+        })
+        self._track(headers, body)
+
+    def deliver_many(self, messages):
+        """
+        Send messages fetched from the inbox in one frame. They are tracked before they are
+        sent, so that they go back to the inbox with the others if the send fails.
+
+        :param list messages: list of [dict] with "headers" and "body"
+        """
+        for message in messages:
+            self._track(message['headers'], message['body'])
+        self.send({
+            'status': 200,
+            'request': 'new',
+            'messages': messages,
+        })
+
+    def ack(self, message_ids):
+        """
+        :param list message_ids: The x-telegram-id of the acknowledged messages
+        :rtype: int The number of messages that were waiting for acknowledgement
+        """
+        acked = 0
+        for message_id in message_ids:
+            if self.unacked.pop(message_id, None) is not None:
+                acked += 1
+        return acked
+
+    def _track(self, headers, body):
+        if 'x-telegram-id' not in headers:  # left in an inbox by an older version
+            headers['x-telegram-id'] = uuid.uuid4().hex
+        self.unacked[headers['x-telegram-id']] = (headers, body)
+
+
+class ConnectionManager(object):
+    def __init__(self, ping_interval=30, idle_timeout=90, max_per_user=8, max_total=10000,
+                 window=100):
+        """
+        Keeps track of the open websockets. Every ping_interval seconds each socket is sent
+        a {"request": "ping"} frame, which clients answer with {"request": "pong"}. A socket
+        that has sent nothing for idle_timeout seconds is taken to be dead, closed and its
+        serving greenlet killed, which releases its listener.
+
+        :param float ping_interval: Seconds between pings
+        :param float idle_timeout: Seconds of silence after which a socket is closed
+        :param int max_per_user: The maximum number of open sockets per user
+        :param int max_total: The maximum number of open sockets
+        :param int window: The maximum number of unacknowledged messages per socket
+        """
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.max_per_user = max_per_user
+        self.max_total = max_total
+        self.window = window
+        self.opened = 0
+        self.closed = 0
+        self.reaped = 0
+        self.refused = 0
+        self._connections = {}
+        """ @type: dict of [str, list of [Connection]] """
+        self._total = 0
+        self._reaper = None
+
+    def open(self, username, wsock, framing):
+        """
+        Register a new socket, served by the current greenlet.
+
+        :rtype: Connection
+        :raises TooManySockets: If the user or the server has too many sockets open
+        """
+        connections = self._connections.get(username, [])
+        if self._total >= self.max_total:
+            self.refused += 1
+            raise TooManySockets(u'Too many open sockets')
+        if len(connections) >= self.max_per_user:
+            self.refused += 1
+            raise TooManySockets(u'Too many open sockets for %s' % username)
+
+        connection = Connection(username, wsock, framing, self.window)
+        self._connections.setdefault(username, []).append(connection)
+        self._total += 1
+        self.opened += 1
+        return connection
+
+    def close(self, connection):
+        """
+        Close a socket and run its on_close callbacks. Closing twice does nothing.
+
+        :param Connection connection: The connection
+        """
+        if connection.closed:
+            return
+        connection.closed = True
+        connections = self._connections.get(connection.username, [])
+        if connection in connections:
+            connections.remove(connection)
+            self._total -= 1
+            if not connections:
+                del self._connections[connection.username]
+        self.closed += 1
+
+        if not connection.wsock.closed:
+            try:
+                connection.wsock.close()
+            except Exception:
+                pass
+        for callback in connection.on_close:
+            try:
+                callback()
+            except Exception as e:
+                log.warning('Closing socket of %s failed: %s', connection.username, e)
+
+    def count(self, username=None):
+        if username is None:
+            return self._total
+        return len(self._connections.get(username, ()))
+
+    def start(self):
+        if self.ping_interval:
+            self._reaper = gevent.spawn(self._reap_periodically)
+
+    def stop(self):
+        if self._reaper is not None:
+            self._reaper.kill()
+            self._reaper = None
+
+    def reap(self):
+        """
+        Close the sockets that have been silent for too long, and ping the others.
+
+        :rtype: int The number of closed sockets
+        """
+        now = time.time()
+        reaped = 0
+        for connections in list(self._connections.values()):
+            for connection in list(connections):
+                if now - connection.last_seen > self.idle_timeout:
+                    log.info('Closing idle socket of %s.', connection.username)
+                    self._kill(connection)
+                    reaped += 1
+                else:
+                    gevent.spawn(self._ping, connection)
+        self.reaped += reaped
+        return reaped
+
+    def collect(self):
+        """
+        :rtype: list of [metrics.Metric]
+        """
+        sockets = metrics.Gauge('telegram_sockets', 'Open websockets')
+        sockets.set(self._total)
+        events = metrics.Counter('telegram_sockets_total', 'Websockets opened and closed',
+                                 ['event'])
+        events.labels('opened').inc(self.opened)
+        events.labels('closed').inc(self.closed)
+        events.labels('reaped').inc(self.reaped)
+        events.labels('refused').inc(self.refused)
+        unacked = metrics.Gauge('telegram_sockets_unacked',
+                                'Messages sent over websockets, not yet acknowledged')
+        unacked.set(sum(len(connection.unacked) for connections in self._connections.values()
+                        for connection in connections))
+        return [sockets, events, unacked]
+
+    def _ping(self, connection):
+        # a dead peer can leave the send buffer full, so a send may block
+        try:
+            with gevent.Timeout(self.ping_interval):
+                connection.send({'request': 'ping'})
+        except (Exception, gevent.Timeout):
+            self._kill(connection)
+            self.reaped += 1
+
+    def _kill(self, connection):
+        if connection.greenlet is not gevent.getcurrent():
+            connection.greenlet.kill(block=False)
+        # closing sends a close frame, which may block as well
+        gevent.spawn(self.close, connection)
+
+    def _reap_periodically(self):
+        while True:
+            gevent.sleep(self.ping_interval)
+            self.reap()
@@ -0,0 +1,42 @@
+from __future__ import print_function
+import sqlite3
+import time
+import gevent
+
+# seconds SQLite itself waits for a lock, blocking the process; longer waits are
+# gevent.sleeps in execute()
+BUSY_TIMEOUT = 0.01
+
+
+def connect(filename):
+    """
+    Open an SQLite database in autocommit mode, for use with execute().
+
+    :param str filename: The database file
+    :rtype: sqlite3.Connection
+    """
+    return sqlite3.connect(filename, isolation_level=None, timeout=BUSY_TIMEOUT)
+
+
+def execute(db, sql, parameters=(), timeout=10):
+    """
+    Execute a statement that may have to wait for another process to release the database
+    lock. While waiting, other greenlets run.
+
+    :param sqlite3.Connection db: The database
+    :param str sql: The statement
+    :param tuple parameters: The values of its parameters
+    :param float timeout: Seconds to keep trying
+    :rtype: sqlite3.Cursor
+    :raises sqlite3.OperationalError: If the database stays locked
+    """
+    deadline = time.time() + timeout
+    delay = 0.001
+    while True:
+        try:
+            return db.execute(sql, parameters)
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e) or time.time() + delay > deadline:
+                raise
+        gevent.sleep(delay)
+        delay = min(delay * 2, 0.1)
@@ -0,0 +1,213 @@
+from __future__ import print_function
+import fcntl
+import os
+import sqlite3
+import time
+from telegram import db
+
+
+def open_directory(settings, config_dir):
+    """
+    Create the user directory described by the "directory" section of office.json. The
+    default, "json", means users.json and passwd are used as they are, and None is returned.
+
+    :param dict settings: The directory settings, e.g. {"backend": "sqlite", "path": "users.db"}
+    :param str config_dir: Directory that relative paths are resolved against
+    :rtype: SQLiteDirectory|None
+    """
+    backend = settings.get('backend', 'json')
+    if backend == 'json':
+        return None
+    elif backend == 'sqlite':
+        return SQLiteDirectory(os.path.join(config_dir, settings.get('path', 'users.db')))
+    else:
+        raise ValueError('Unknown directory backend "%s"' % str(backend))
+
+
+_FIELDS = ('fullname', 'email', 'admin', 'public_key', 'private_key')
+
+
+class SQLiteDirectory(object):
+    def __init__(self, filename):
+        """
+        Keeps users, their keys and password hashes in an SQLite database, one row per user.
+
+        Users are looked up by username one at a time, so nothing is loaded up front and a
+        new user is a single insert. It can stand in for the users dict of the PostOffice:
+        get(), "in" and len() work the same way, and changes made by telegram_admin are
+        seen at once, without a reload.
+
+        :param str filename: The database file
+        """
+        self.filename = filename
+        self._db = db.connect(filename)
+        db.execute(self._db, 'PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS users ('
+                         'username TEXT PRIMARY KEY, '
+                         'fullname TEXT, '
+                         'email TEXT, '
+                         'admin INTEGER NOT NULL DEFAULT 0, '
+                         'public_key TEXT, '
+                         'private_key TEXT, '
+                         'password TEXT)')
+
+    def __contains__(self, username):
+        return self._db.execute('SELECT 1 FROM users WHERE username = ?',
+                                (username,)).fetchone() is not None
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+    def __iter__(self):
+        return (username for username, in
+                self._db.execute('SELECT username FROM users ORDER BY username'))
+
+    def get(self, username, default=None):
+        """
+        Look up a user.
+
+        :param str username: The username
+        :param default: Returned if there is no such user
+        :rtype: dict With the same keys as an entry in users.json
+        """
+        row = self._db.execute('SELECT fullname, email, admin, public_key, private_key '
+                               'FROM users WHERE username = ?', (username,)).fetchone()
+        if row is None:
+            return default
+        user = dict(zip(_FIELDS, row))
+        user['admin'] = bool(user['admin'])
+        return user
+
+    def add(self, username, user, password=None):
+        """
+        Add a user.
+
+        :param str username: The username
+        :param dict user: The user, with the same keys as an entry in users.json
+        :param str password: The password hash
+        """
+        try:
+            db.execute(self._db, 'INSERT INTO users (username, fullname, email, admin, '
+                                 'public_key, private_key, password) '
+                                 'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       _row(username, user, password))
+        except sqlite3.IntegrityError:
+            raise NameError(u'User "%s" already exists.' % username)
+
+    def remove(self, username):
+        db.execute(self._db, 'DELETE FROM users WHERE username = ?', (username,))
+
+    def get_password(self, username):
+        """
+        :param str username: The username
+        :rtype: str|None The password hash, None if there is no such user
+        """
+        row = self._db.execute('SELECT password FROM users WHERE username = ?',
+                               (username,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_password(self, username, password):
+        """
+        :param str username: The username
+        :param str password: The new password hash
+        """
+        db.execute(self._db, 'UPDATE users SET password = ? WHERE username = ?',
+                   (password, username))
+
+    def import_users(self, users, passwords):
+        """
+        Add many users in one transaction, e.g. from users.json and passwd. Users that
+        already exist are left as they are, as they may have been added or changed while
+        the import was prepared.
+
+        :param dict users: The users, as in users.json
+        :param dict passwords: Password hashes by username, as in passwd
+        :rtype: list of [str] The usernames that already existed and were skipped
+        """
+        usernames = set(users) | set(passwords)
+        db.execute(self._db, 'BEGIN IMMEDIATE')
+        try:
+            existing = sorted(username for username, in
+                              self._db.execute('SELECT username FROM users')
+                              if username in usernames)
+            self._db.executemany(
+                'INSERT OR IGNORE INTO users (username, fullname, email, admin, public_key, '
+                'private_key, password) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (_row(username, users.get(username, {}), passwords.get(username))
+                 for username in usernames))
+        except:
+            self._db.execute('ROLLBACK')
+            raise
+        db.execute(self._db, 'COMMIT')
+        return existing
+
+    def close(self):
+        self._db.close()
+
+
+def read_passwd(filename):
+    """
+    Read a passwd file.
+
+    :param str filename: The passwd file
+    :rtype: dict of [str, str] Password hashes by username
+    """
+    passwords = {}
+    with open(filename, 'r') as f:
+        for l in f.readlines():
+            if l.strip():
+                user, password = l.strip().split(':', 1)
+                passwords[user] = password
+    return passwords
+
+
+def update_passwd(filename, passwords, replace=True):
+    """
+    Add or replace password hashes in a passwd file, leaving the other lines as they are.
+    The file is read and rewritten under a lock and replaced by renaming, so that writers in
+    other processes do not undo each other's changes and readers never see half a file.
+
+    :param str filename: The passwd file
+    :param dict passwords: Password hashes by username
+    :param bool replace: Whether to replace the hashes of users already in the file
+    :rtype: list of [str] The usernames already in the file that were left as they are
+    """
+    passwords = dict(passwords)
+    lock = open(filename + '.lock', 'a')
+    try:
+        while True:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except IOError:
+                time.sleep(0.01)  # cooperative when monkey patched
+
+        lines = []
+        if os.path.exists(filename):
+            with open(filename, 'r') as f:
+                lines = [l for l in f.readlines() if l.strip()]
+        kept = []
+        for n, l in enumerate(lines):
+            user = l.strip().split(':', 1)[0]
+            if user not in passwords:
+                continue
+            elif replace:
+                lines[n] = '%s:%s\n' % (user, passwords.pop(user))
+            else:
+                del passwords[user]
+                kept.append(user)
+        lines.extend('%s:%s\n' % (user, password) for user, password in passwords.items())
+
+        temp_filename = '%s.%i.tmp' % (filename, os.getpid())
+        with open(temp_filename, 'w') as f:
+            f.writelines(lines)
+        os.rename(temp_filename, filename)
+        return kept
+    finally:
+        lock.close()
+
+
+def _row(username, user, password):
+    return (username, user.get('fullname'), user.get('email'), int(bool(user.get('admin'))),
+            user.get('public_key'), user.get('private_key'), password)
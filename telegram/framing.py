@@ -0,0 +1,217 @@
+from __future__ import print_function
+import json
+import struct
+import zlib
+
+# strings sent as one byte; only ever append to this list, clients depend on the order
+INTERNED = [
+    'status', 'request', 'headers', 'body', 'messages', 'max', 'error',
+    'new', 'proxy', 'close',
+    'x-telegram-from', 'x-telegram-to', 'x-telegram-sign', 'x-telegram-sign-method',
+    'X-Telegram-To', 'X-Telegram-From', 'content-type', 'text/plain', 'RSA',
+    'ping', 'pong', 'ack', 'id', 'x-telegram-id', 'x-telegram-seq',
+]
+_INTERNED_INDEX = {text: n for n, text in enumerate(INTERNED)}
+
+_DEFLATED = 0x01
+
+# limits for frames from clients: inflated size in bytes, and nesting of lists and dicts
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+MAX_DEPTH = 32
+
+_NONE, _FALSE, _TRUE, _INT, _STR, _LIST, _DICT, _FLOAT = range(8)
+_REF = 0x80
+_DOUBLE = struct.Struct('<d')
+
+
+def get_framing(name, compress_threshold=256):
+    """
+    :param str name: "json" or "binary"
+    :param int compress_threshold: Deflate binary frames larger than this many bytes
+    :rtype: JSONFraming|BinaryFraming
+    """
+    if name == 'json':
+        return JSONFraming()
+    elif name == 'binary':
+        return BinaryFraming(compress_threshold)
+    raise ValueError('Unknown framing "%s"' % str(name))
+
+
+class JSONFraming(object):
+    """
+    Frames as JSON text, as understood by the web client.
+    """
+    name = 'json'
+
+    def encode(self, frame):
+        return json.dumps(frame)
+
+    def decode(self, data):
+        return decode(data)
+
+
+class BinaryFraming(object):
+    name = 'binary'
+
+    def __init__(self, compress_threshold=256):
+        """
+        Compact binary frames, see encode().
+
+        :param int compress_threshold: Deflate frames larger than this many bytes
+        """
+        self.compress_threshold = compress_threshold
+
+    def encode(self, frame):
+        return encode(frame, self.compress_threshold)
+
+    def decode(self, data):
+        return decode(data)
+
+
+def encode(frame, compress_threshold=256):
+    """
+    Encode a frame of None, booleans, integers, floats, strings, lists and dicts in a
+    compact binary form: a flags byte, then tagged values with varint lengths. Strings in
+    INTERNED, like header names, take a single byte. A frame larger than compress_threshold
+    is deflated if that makes it smaller.
+
+    :param frame: The frame, e.g. {"status": 200, "request": "new", "messages": [...]}
+    :param int compress_threshold: Deflate frames larger than this many bytes, 0 never
+    :rtype: bytes
+    :raises ValueError: If an integer does not fit in 64 bits
+    """
+    out = bytearray()
+    _encode(frame, out)
+    if compress_threshold and len(out) > compress_threshold:
+        deflated = zlib.compress(bytes(out), 6)
+        if len(deflated) < len(out):
+            return bytes(bytearray([_DEFLATED])) + deflated
+    return bytes(bytearray([0])) + bytes(out)
+
+
+def decode(data):
+    """
+    Decode a frame made by encode(). Text is taken to be a JSON frame.
+
+    :param bytes data: The frame
+    :raises ValueError: If the frame is malformed, inflates beyond MAX_FRAME_SIZE or nests
+                        deeper than MAX_DEPTH
+    """
+    # frames come from clients, so anything may go wrong; it is all a bad frame
+    try:
+        if not isinstance(data, (bytes, bytearray)):
+            return json.loads(data)
+        data = bytes(data)
+        payload = data[1:]
+        if bytearray(data[:1])[0] & _DEFLATED:
+            inflater = zlib.decompressobj()
+            payload = inflater.decompress(payload, MAX_FRAME_SIZE)
+            if inflater.unconsumed_tail:
+                raise ValueError('Frame larger than %i bytes' % MAX_FRAME_SIZE)
+        payload = bytearray(payload)
+        value, pos = _decode(payload, 0, 0)
+        if pos != len(payload):
+            raise ValueError('%i bytes after the frame' % (len(payload) - pos))
+    except ValueError:
+        raise
+    except Exception as e:
+        raise ValueError('Bad frame: %s' % str(e))
+    return value
+
+
+def _encode(value, out):
+    if value is None:
+        out.append(_NONE)
+    elif value is True:
+        out.append(_TRUE)
+    elif value is False:
+        out.append(_FALSE)
+    elif isinstance(value, int):
+        if not -2 ** 63 <= value < 2 ** 63:
+            raise ValueError('Integer out of range: %i' % value)
+        out.append(_INT)
+        _varint((value << 1) ^ (value >> 63), out)
+    elif isinstance(value, float):
+        out.append(_FLOAT)
+        out.extend(_DOUBLE.pack(value))
+    elif isinstance(value, (list, tuple)):
+        out.append(_LIST)
+        _varint(len(value), out)
+        for item in value:
+            _encode(item, out)
+    elif isinstance(value, dict):
+        out.append(_DICT)
+        _varint(len(value), out)
+        for key, item in value.items():
+            _encode(key, out)
+            _encode(item, out)
+    else:
+        ref = _INTERNED_INDEX.get(value)
+        if ref is not None:
+            out.append(_REF | ref)
+            return
+        if not isinstance(value, bytes):
+            value = value.encode('utf-8')
+        out.append(_STR)
+        _varint(len(value), out)
+        out.extend(value)
+
+
+def _decode(data, pos, depth):
+    tag = data[pos]
+    pos += 1
+    if depth > MAX_DEPTH:
+        raise ValueError('Frame nested deeper than %i' % MAX_DEPTH)
+    if tag & _REF:
+        return INTERNED[tag & ~_REF], pos
+    elif tag == _STR:
+        length, pos = _read_varint(data, pos)
+        return bytes(data[pos:pos + length]).decode('utf-8'), pos + length
+    elif tag == _DICT:
+        length, pos = _read_varint(data, pos)
+        value = {}
+        for n in range(length):
+            key, pos = _decode(data, pos, depth + 1)
+            value[key], pos = _decode(data, pos, depth + 1)
+        return value, pos
+    elif tag == _LIST:
+        length, pos = _read_varint(data, pos)
+        value = []
+        for n in range(length):
+            item, pos = _decode(data, pos, depth + 1)
+            value.append(item)
+        return value, pos
+    elif tag == _INT:
+        zigzag, pos = _read_varint(data, pos)
+        return (zigzag >> 1) ^ -(zigzag & 1), pos
+    elif tag == _NONE:
+        return None, pos
+    elif tag == _TRUE:
+        return True, pos
+    elif tag == _FALSE:
+        return False, pos
+    elif tag == _FLOAT:
+        return _DOUBLE.unpack_from(bytes(data[pos:pos + _DOUBLE.size]))[0], pos + _DOUBLE.size
+    raise ValueError('Bad frame tag %i at %i' % (tag, pos - 1))
+
+
+def _varint(value, out):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+        if shift > 63:
+            # more than the 10 bytes of a 64 bit integer
+            raise ValueError('Varint too long at %i' % pos)
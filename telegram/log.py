@@ -0,0 +1,172 @@
+from __future__ import print_function
+import json
+import logging
+import random
+import sys
+import time
+from collections import deque
+from gevent import monkey
+
+try:
+    _start_thread = monkey.get_original('_thread', 'start_new_thread')
+except (ImportError, AttributeError):
+    _start_thread = monkey.get_original('thread', 'start_new_thread')
+_sleep = monkey.get_original('time', 'sleep')
+_RLock = monkey.get_original('threading', 'RLock')
+
+SAMPLED = {'sampled': True}
+
+_queued_handler = None
+
+
+def get_logger(name):
+    """
+    :param str name: The module name, e.g. "telegram.post.office"
+    :rtype: logging.Logger
+    """
+    return logging.getLogger(name)
+
+
+def configure(level='info', json_format=False, sample_rate=1.0, filename=None, queued=True):
+    """
+    Set up logging for the server. Per-message events are logged with extra=SAMPLED, and
+    only sample_rate of them are kept. Records are written by a real thread, so that a slow
+    terminal or disk never blocks a greenlet.
+
+    :param str level: "debug", "info", "warning" or "error"
+    :param bool json_format: Write one JSON object per record instead of plain text
+    :param float sample_rate: Fraction of the per-message records to keep
+    :param str filename: Append to this file instead of writing to stderr
+    :param bool queued: Write from a background thread
+    """
+    global _queued_handler
+
+    handler = logging.FileHandler(filename) if filename else logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JSONFormatter() if json_format else logging.Formatter(
+        '%(asctime)s %(process)d %(levelname)s %(name)s: %(message)s'))
+    if queued:
+        if _queued_handler is not None:
+            _queued_handler.close()
+        handler = _queued_handler = QueuedHandler(handler)
+    handler.addFilter(SampleFilter(sample_rate))
+
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    # debug output of the libraries is rarely of interest
+    level = getattr(logging, level.upper())
+    root.setLevel(max(level, logging.INFO))
+    logging.getLogger('telegram').setLevel(level)
+
+
+def shutdown():
+    """
+    Write out the queued records, e.g. before the process exits.
+    """
+    if _queued_handler is not None:
+        _queued_handler.close()
+
+
+class SampleFilter(logging.Filter):
+    def __init__(self, rate):
+        """
+        Lets through all records, except that of those logged with extra=SAMPLED only a
+        fraction is kept.
+
+        :param float rate: The fraction of sampled records to keep, 0.0 - 1.0
+        """
+        logging.Filter.__init__(self)
+        self.rate = rate
+
+    def filter(self, record):
+        if getattr(record, 'sampled', False) and self.rate < 1.0:
+            return random.random() < self.rate
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats a record as one line of JSON with time, level, logger, process and message,
+    plus the exception if there is one.
+    """
+    def format(self, record):
+        entry = {
+            'time': record.created,
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'pid': record.process,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+
+class QueuedHandler(logging.Handler):
+    def __init__(self, target, max_queued=10000, poll_interval=0.05):
+        """
+        Hands records to a real (not monkey patched) thread that passes them on to the target
+        handler. Emitting only appends to a deque. If the writer falls more than max_queued
+        records behind, new records are dropped and counted.
+
+        :param logging.Handler target: The handler that does the writing
+        :param int max_queued: The maximum number of records waiting to be written
+        :param float poll_interval: Seconds the writer sleeps when there is nothing to write
+        """
+        logging.Handler.__init__(self)
+        self.target = target
+        self.target.lock = _RLock()  # used from the writer thread only
+        self.max_queued = max_queued
+        self.poll_interval = poll_interval
+        self.dropped = 0
+        self._records = deque()
+        self._running = True
+        self._stopped = False
+        _start_thread(self._write, ())
+
+    def createLock(self):
+        # emit() only appends to a deque, which is thread safe by itself
+        self.lock = None
+
+    def handle(self, record):
+        if self.filter(record):
+            self.emit(record)
+        return record
+
+    def emit(self, record):
+        if len(self._records) >= self.max_queued:
+            self.dropped += 1
+            return
+        # resolve the message now; the arguments may change before the writer gets to them
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self._records.append(record)
+
+    def close(self):
+        self._running = False
+        deadline = time.time() + 5
+        while not self._stopped and time.time() < deadline:
+            _sleep(self.poll_interval)
+        logging.Handler.close(self)
+
+    def _write(self):
+        while True:
+            try:
+                record = self._records.popleft()
+            except IndexError:
+                if not self._running:
+                    break
+                _sleep(self.poll_interval)
+                continue
+            try:
+                self.target.handle(record)
+            except Exception:
+                self.dropped += 1
+        self.target.close()
+        self._stopped = True
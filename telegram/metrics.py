@@ -0,0 +1,231 @@
+from __future__ import print_function
+import bisect
+import time
+from functools import wraps
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+
+
+class Registry(object):
+    def __init__(self):
+        """
+        Keeps the metrics of a process and writes them in the Prometheus text exposition
+        format.
+
+        Besides metrics that are updated as things happen, collectors can be registered:
+        functions called at each exposition that return freshly made metrics, for values
+        that are cheaper to read when asked for, like queue depths.
+        """
+        self._metrics = []
+        """ @type: list of [Metric] """
+        self._collectors = []
+        """ @type: list of [function] """
+
+    def add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def register(self, collector):
+        """
+        :param function collector: Called without arguments, returns a list of metrics
+        """
+        self._collectors.append(collector)
+
+    def unregister(self, collector):
+        if collector in self._collectors:
+            self._collectors.remove(collector)
+
+    def exposition(self):
+        """
+        :rtype: str All metrics in the text exposition format, version 0.0.4
+        """
+        metrics = list(self._metrics)
+        for collector in self._collectors:
+            metrics.extend(collector())
+        return ''.join(metric.exposition() for metric in metrics)
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, labels=()):
+    return REGISTRY.add(Counter(name, help, labels))
+
+
+def gauge(name, help, labels=()):
+    return REGISTRY.add(Gauge(name, help, labels))
+
+
+def histogram(name, help, labels=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.add(Histogram(name, help, labels, buckets))
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        """
+        A named metric, with one value, or one value per combination of label values.
+
+        :param str name: The metric name, e.g. "telegram_sorted_total"
+        :param str help: What is measured
+        :param tuple labels: The label names
+        """
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._children = {}
+        """ @type: dict of [tuple, object] """
+
+    def labels(self, *values):
+        """
+        Get the metric for one combination of label values.
+
+        :rtype: Metric
+        """
+        assert len(values) == len(self.label_names), 'Wrong number of labels for ' + self.name
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def exposition(self):
+        lines = ['# HELP %s %s\n' % (self.name, self.help),
+                 '# TYPE %s %s\n' % (self.name, self.type)]
+        if not self.label_names and () not in self._children:
+            self.labels()
+        for values, child in sorted(self._children.items()):
+            labels = ','.join('%s="%s"' % (name, _escape(value))
+                              for name, value in zip(self.label_names, values))
+            lines.extend(child.samples(self.name, labels))
+        return ''.join(lines)
+
+    def _new_child(self):
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _new_child(self):
+        return _Value()
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().inc(-amount)
+
+    def _new_child(self):
+        return _Value()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        """
+        Counts observations, like latencies, in buckets of increasing upper bounds.
+
+        :param tuple buckets: The upper bounds of the buckets, in increasing order
+        """
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def _new_child(self):
+        return _Buckets(self.buckets)
+
+
+class _Value(object):
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labels):
+        return ['%s%s %s\n' % (name, '{%s}' % labels if labels else '', _number(self.value))]
+
+
+class _Buckets(object):
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def time(self):
+        """
+        Observe the seconds spent in a with block, or in each call of a decorated function.
+        """
+        return _Timer(self)
+
+    def samples(self, name, labels):
+        prefix = labels + ',' if labels else ''
+        lines = []
+        count = 0
+        for bound, bucket_count in zip(self.bounds + (float('inf'),), self.counts):
+            count += bucket_count
+            lines.append('%s_bucket{%sle="%s"} %i\n' % (name, prefix, _number(bound), count))
+        labels = '{%s}' % labels if labels else ''
+        lines.append('%s_sum%s %s\n' % (name, labels, _number(self.sum)))
+        lines.append('%s_count%s %i\n' % (name, labels, count))
+        return lines
+
+
+class _Timer(object):
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self._started = None
+
+    def __enter__(self):
+        self._started = time.time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._buckets.observe(time.time() - self._started)
+
+    def __call__(self, function):
+        @wraps(function)
+        def timed(*args, **kwargs):
+            started = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self._buckets.observe(time.time() - started)
+        return timed
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,81 @@
+from __future__ import print_function
+import time
+from collections import OrderedDict
+
+
+class RateLimited(Exception):
+    pass
+
+
+class Overloaded(Exception):
+    pass
+
+
+class InboxFull(Exception):
+    pass
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        """
+        Allows rate events per second on average, and up to burst at once.
+
+        :param float rate: Tokens added per second
+        :param int burst: The maximum number of tokens
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+
+    def take(self, now=None):
+        """
+        Take a token if there is one.
+
+        :rtype: bool True if a token was taken
+        """
+        now = now or time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class SenderLimiter(object):
+    def __init__(self, rate=0, burst=None, max_senders=100000):
+        """
+        Limits the messages each sender may post, with a token bucket per sender. The
+        buckets of the senders heard from least recently are dropped beyond max_senders;
+        a dropped bucket was full long ago anyway.
+
+        :param float rate: Messages per second per sender, 0 for no limit
+        :param int burst: Messages a sender may post at once (default rate, at least 1)
+        :param int max_senders: The maximum number of buckets to keep
+        """
+        self.rate = rate
+        self.burst = burst or max(int(rate), 1)
+        self.max_senders = max_senders
+        self.limited = 0
+        self._buckets = OrderedDict()
+        """ @type: OrderedDict of [str, TokenBucket] """
+
+    def admit(self, sender):
+        """
+        Count a message from a sender, or refuse it.
+
+        :param str sender: The sender "username[@domain]"
+        :raises RateLimited: If the sender has no tokens left
+        """
+        if not self.rate:
+            return
+        bucket = self._buckets.pop(sender, None)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            if len(self._buckets) >= self.max_senders:
+                self._buckets.popitem(last=False)
+        self._buckets[sender] = bucket
+        if not bucket.take():
+            self.limited += 1
+            raise RateLimited(u'Too many messages from %s' % sender)
@@ -0,0 +1,52 @@
+from __future__ import print_function
+from collections import OrderedDict, deque
+
+
+class MessageHistory(object):
+    def __init__(self, size=0, max_users=1000):
+        """
+        Keeps the last messages delivered to each user, so that a client that lost its
+        connection can catch up from the x-telegram-seq of the last message it got. The
+        histories of the users heard from least recently are dropped beyond max_users. Off
+        by default, as it keeps whole messages in memory.
+
+        :param int size: The number of messages to keep per user, 0 for none
+        :param int max_users: The maximum number of histories to keep
+        """
+        self.size = size
+        self.max_users = max_users
+        self._histories = OrderedDict()
+        """ @type: OrderedDict of [str, deque of [tuple of [int, dict, str]]] """
+
+    def record(self, username, headers, body):
+        """
+        :param str username: The receiver
+        :param dict headers: Message headers, with x-telegram-seq
+        :param unicode body: Message Body
+        """
+        if not self.size or 'x-telegram-seq' not in headers:
+            return
+        history = self._histories.pop(username, None)
+        if history is None:
+            history = deque(maxlen=self.size)
+            if len(self._histories) >= self.max_users:
+                self._histories.popitem(last=False)
+        self._histories[username] = history
+        history.append((int(headers['x-telegram-seq']), headers, body))
+
+    def since(self, username, seq):
+        """
+        The messages of a user after a sequence number, as far as they are kept.
+
+        :param str username: The receiver
+        :param int seq: The x-telegram-seq of the last message the client got
+        :rtype: list of [tuple of [dict, str]]
+        """
+        return [(headers, body) for message_seq, headers, body
+                in self._histories.get(username, ()) if message_seq > seq]
+
+    def count(self):
+        """
+        The number of messages kept, of all users.
+        """
+        return sum(len(history) for history in self._histories.values())
@@ -0,0 +1,601 @@
+from __future__ import print_function
+import gc
+import glob
+import heapq
+import json
+import marshal
+import os
+import struct
+from collections import deque
+import gevent
+from gevent.event import Event
+from gevent.queue import Queue, Empty
+from telegram import db
+from telegram.log import get_logger
+
+log = get_logger(__name__)
+
+
+def open_inbox(settings, config_dir):
+    """
+    Create the inbox backend described by the "inbox" section of office.json.
+
+    :param dict settings: The inbox settings, e.g. {"backend": "sqlite", "path": "inbox.db"}
+    :param str config_dir: Directory that relative paths are resolved against
+    :rtype: MemoryInbox|JournaledInbox|SQLiteInbox
+    """
+    backend = settings.get('backend', 'memory')
+    if backend == 'memory':
+        return MemoryInbox()
+    elif backend == 'journal':
+        return JournaledInbox(os.path.join(config_dir, settings.get('path', 'inbox')),
+                              snapshot_interval=settings.get('snapshot_interval', 300),
+                              flush_interval=settings.get('flush_interval', 0.05),
+                              fsync=settings.get('fsync', False))
+    elif backend == 'sqlite':
+        filename = os.path.join(config_dir, settings.get('path', 'inbox.db'))
+        return SQLiteInbox(filename,
+                           batch_size=settings.get('batch_size', 256),
+                           flush_interval=settings.get('flush_interval', 0.05),
+                           shared=settings.get('shared', False))
+    else:
+        raise ValueError('Unknown inbox backend "%s"' % str(backend))
+
+
+def message_size(headers, body):
+    """
+    The approximate wire size of a message, used to bound batched fetches.
+
+    :param dict headers: Message headers
+    :param unicode body: Message body
+    :rtype: int
+    """
+    return len(body) + sum(len(k) + len(v) for k, v in headers.items())
+
+
+class MemoryInbox(object):
+    """
+    Keeps undelivered messages in one gevent Queue per user. Nothing survives a restart.
+    """
+    def __init__(self):
+        self._queues = {}
+        """ @type: dict of [str, gevent.queue.Queue] """
+
+    def __contains__(self, username):
+        return username in self._queues
+
+    def create(self, username):
+        """
+        Create an inbox for a user, unless there already is one.
+
+        :param str username: The username of the inbox owner
+        """
+        if username not in self._queues:
+            self._queues[username] = Queue()
+
+    def remove(self, username):
+        """
+        Remove the inbox of a user, along with the messages in it.
+
+        :param str username: The username of the inbox owner
+        """
+        self._queues.pop(username, None)
+
+    def put(self, username, headers, body):
+        self._queues[username].put((headers, body))
+
+    def get(self, username):
+        """
+        Take the oldest message out of an inbox.
+
+        :param str username: The username
+        :rtype: tuple of [dict, str]|None
+        """
+        try:
+            return self._queues[username].get_nowait()
+        except Empty:
+            return None
+
+    def get_many(self, username, max_count, max_bytes):
+        """
+        Take up to max_count of the oldest messages out of an inbox, stopping before
+        max_bytes would be exceeded. The first message is always returned.
+
+        :param str username: The username
+        :param int max_count: The maximum number of messages
+        :param int max_bytes: The maximum combined size of the messages
+        :rtype: list of [tuple of [dict, str]]
+        """
+        queue = self._queues[username]
+        messages = []
+        total = 0
+        while len(messages) < max_count:
+            try:
+                headers, body = queue.peek_nowait()
+            except Empty:
+                break
+            total += message_size(headers, body)
+            if messages and total > max_bytes:
+                break
+            messages.append(queue.get_nowait())
+        return messages
+
+    def wait(self, username, timeout):
+        """
+        Block until the inbox holds a message or the timeout expires.
+
+        :param str username: The username
+        :param float timeout: Maximum number of seconds to wait
+        :rtype: bool True if there is a message to fetch
+        """
+        try:
+            self._queues[username].peek(timeout=timeout)
+            return True
+        except Empty:
+            return False
+
+    def size(self, username):
+        return self._queues[username].qsize()
+
+    def total(self):
+        """
+        :rtype: int The number of messages in all inboxes
+        """
+        return sum(queue.qsize() for queue in self._queues.values())
+
+    def largest(self, count):
+        """
+        :param int count: The maximum number of inboxes
+        :rtype: list of [tuple of [str, int]] The users with the most messages waiting, and
+                how many, largest first
+        """
+        return heapq.nlargest(count, ((username, queue.qsize())
+                                      for username, queue in self._queues.items()
+                                      if queue.qsize()),
+                              key=lambda item: item[1])
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+_LENGTH = struct.Struct('<I')
+
+
+class JournaledInbox(MemoryInbox):
+    def __init__(self, path, snapshot_interval=300, flush_interval=0.05, fsync=False):
+        """
+        A MemoryInbox that survives a restart. Every put and get is appended to a journal,
+        and every snapshot_interval seconds a forked child process writes all queues to a
+        snapshot, from the copy-on-write memory it shares with the server, while the server
+        goes on with a new journal. On startup the snapshot is loaded and the journals
+        written after it are replayed.
+
+        Files are "<path>.snapshot" and "<path>.journal.<generation>". Journal records, and
+        the snapshot, are marshal dumps with a 4-byte length in front. The journal is
+        written out every flush_interval seconds, so a crash loses at most that much.
+
+        :param str path: Path and prefix of the files, e.g. "/etc/telegram/inbox"
+        :param float snapshot_interval: Seconds between snapshots, 0 for none
+        :param float flush_interval: Seconds between writes of the journal
+        :param bool fsync: Sync the journal to disk on each write, not only to the OS
+        """
+        super(JournaledInbox, self).__init__()
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self._records = []
+        """ @type: list of [bytes] """
+        self._flusher = None
+        self._snapshotter = None
+        self._child = None
+
+        # millions of new tuples and dicts would set off the cycle collector over and over
+        gc.disable()
+        try:
+            count, self.generation = self._recover()
+        finally:
+            gc.enable()
+        log.info('Recovered %i queued messages from %s.', count, path)
+        self._journal = open(self._journal_filename(self.generation), 'ab')
+        if snapshot_interval:
+            self._snapshotter = gevent.spawn(self._snapshot_periodically)
+
+    def create(self, username):
+        if username not in self._queues:
+            super(JournaledInbox, self).create(username)
+            self._write(('c', username))
+
+    def remove(self, username):
+        super(JournaledInbox, self).remove(username)
+        self._write(('r', username))
+
+    def put(self, username, headers, body):
+        super(JournaledInbox, self).put(username, headers, body)
+        self._write(('p', username, headers, body))
+
+    def get(self, username):
+        message = super(JournaledInbox, self).get(username)
+        if message is not None:
+            self._write(('g', username, 1))
+        return message
+
+    def get_many(self, username, max_count, max_bytes):
+        messages = super(JournaledInbox, self).get_many(username, max_count, max_bytes)
+        if messages:
+            self._write(('g', username, len(messages)))
+        return messages
+
+    def flush(self):
+        """
+        Write the buffered journal records out.
+        """
+        if self._flusher is not None:
+            self._flusher.kill(block=False)
+            self._flusher = None
+        if self._records:
+            records, self._records = self._records, []
+            self._journal.write(b''.join(records))
+            self._journal.flush()
+            if self.fsync:
+                os.fsync(self._journal.fileno())
+
+    def snapshot(self):
+        """
+        Start a new journal and fork a child that writes the queues to a snapshot. When it
+        is done, the journals before the new one are deleted.
+
+        :rtype: bool False if the previous snapshot is still being written
+        """
+        if self._child is not None:
+            return False
+        self.flush()
+        self._journal.close()
+        self.generation += 1
+        self._journal = open(self._journal_filename(self.generation), 'ab')
+
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                self._write_snapshot()
+                status = 0
+            finally:
+                os._exit(status)
+        self._child = gevent.spawn(self._await_snapshot, pid, self.generation)
+        return True
+
+    def close(self):
+        if self._snapshotter is not None:
+            self._snapshotter.kill()
+        if self._child is not None:
+            self._child.join()
+        self.flush()
+        self._journal.close()
+
+    def _write(self, record):
+        data = marshal.dumps(record)
+        self._records.append(_LENGTH.pack(len(data)) + data)
+        if self._flusher is None:
+            self._flusher = gevent.spawn_later(self.flush_interval, self._scheduled_flush)
+
+    def _scheduled_flush(self):
+        self._flusher = None
+        self.flush()
+
+    def _journal_filename(self, generation):
+        return '%s.journal.%i' % (self.path, generation)
+
+    def _journals(self):
+        journals = []
+        for filename in glob.glob(self.path + '.journal.*'):
+            try:
+                journals.append((int(filename.rsplit('.', 1)[1]), filename))
+            except ValueError:
+                pass
+        return sorted(journals)
+
+    def _write_snapshot(self):
+        # runs in the child, on the memory of the parent as it was at the fork
+        queues = {username: list(queue.queue) for username, queue in self._queues.items()}
+        data = marshal.dumps((self.generation, queues))
+        temp_filename = self.path + '.snapshot.tmp'
+        with open(temp_filename, 'wb') as f:
+            f.write(_LENGTH.pack(len(data)))
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_filename, self.path + '.snapshot')
+
+    def _await_snapshot(self, pid, generation):
+        while True:
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if done:
+                break
+            gevent.sleep(0.1)
+        self._child = None
+        if status != 0:
+            log.error('Writing the inbox snapshot failed (status %i).', status)
+            return
+        for journal_generation, filename in self._journals():
+            if journal_generation < generation:
+                os.unlink(filename)
+
+    def _snapshot_periodically(self):
+        while True:
+            gevent.sleep(self.snapshot_interval)
+            self.snapshot()
+
+    def _recover(self):
+        """
+        Load the snapshot and replay the journals written after it.
+
+        :rtype: tuple of [int, int] The number of messages and the newest journal generation
+        """
+        generation = 0
+        items = {}
+        """ @type: dict of [str, deque] """
+        try:
+            with open(self.path + '.snapshot', 'rb') as f:
+                f.read(_LENGTH.size)
+                generation, snapshot = marshal.loads(f.read())
+            items = {username: deque(messages) for username, messages in snapshot.items()}
+        except IOError:
+            pass
+
+        for journal_generation, filename in self._journals():
+            if journal_generation < generation:
+                os.unlink(filename)  # left over from a crash just after a snapshot
+                continue
+            generation = journal_generation
+            with open(filename, 'rb') as f:
+                data = f.read()
+            for record in _read_records(data):
+                op, username = record[0], record[1]
+                if op == 'p':
+                    items.setdefault(username, deque()).append((record[2], record[3]))
+                elif op == 'g':
+                    messages = items[username]
+                    for i in range(record[2]):
+                        messages.popleft()
+                elif op == 'c':
+                    items.setdefault(username, deque())
+                elif op == 'r':
+                    items.pop(username, None)
+
+        self._queues = {username: Queue(items=messages) for username, messages in items.items()}
+        return sum(len(messages) for messages in items.values()), generation
+
+
+def _read_records(data):
+    pos = 0
+    while pos + _LENGTH.size <= len(data):
+        length, = _LENGTH.unpack_from(data, pos)
+        pos += _LENGTH.size
+        if pos + length > len(data):
+            break  # cut short by a crash
+        yield marshal.loads(data[pos:pos + length])
+        pos += length
+
+
+class SQLiteInbox(object):
+    """
+    Keeps undelivered messages in an SQLite database in WAL mode, so they survive a restart
+    and only the current write batch is held in memory.
+
+    Writes are grouped into one transaction (and so one fsync) per ``batch_size`` operations
+    or per ``flush_interval`` seconds, whichever comes first.
+
+    A ``shared`` inbox can be used by several server processes at once. Each operation is
+    then its own immediate transaction, so no process holds the write lock for long and a
+    message is never taken by two processes, and the WAL is synced at checkpoints only.
+    """
+    def __init__(self, filename, batch_size=256, flush_interval=0.05, shared=False):
+        self.filename = filename
+        self.batch_size = 1 if shared else batch_size
+        self.flush_interval = flush_interval
+        self.shared = shared
+        self.on_commit = None
+        """ @type: function called with each username that got messages in a commit """
+        self._committed_users = set()
+        self._users = set()
+        self._waiters = {}
+        """ @type: dict of [str, gevent.event.Event] """
+        self._pending = 0
+        self._in_batch = False
+        self._flusher = None
+
+        self._db = db.connect(filename)
+        db.execute(self._db, 'PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=%s' % ('NORMAL' if shared else 'FULL'))
+        self._db.execute('CREATE TABLE IF NOT EXISTS inbox ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'username TEXT NOT NULL, '
+                         'headers TEXT NOT NULL, '
+                         'body TEXT NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS inbox_username ON inbox (username, id)')
+        self._create_sizes()
+
+        log.info('Recovered %i queued messages from %s.', self.total(), filename)
+
+    def __contains__(self, username):
+        return username in self._users
+
+    def create(self, username):
+        """
+        Create an inbox for a user. Messages stored by an earlier run are kept.
+
+        :param str username: The username of the inbox owner
+        """
+        self._users.add(username)
+
+    def remove(self, username):
+        """
+        Stop accepting messages for a user. Messages already stored stay on disk, in case
+        the user comes back.
+
+        :param str username: The username of the inbox owner
+        """
+        self._users.discard(username)
+
+    def put(self, username, headers, body):
+        self._begin()
+        self._db.execute('INSERT INTO inbox (username, headers, body) VALUES (?, ?, ?)',
+                         (username, json.dumps(headers), body))
+        self._committed_users.add(username)
+        self._written()
+        self.wake(username)
+
+    def get(self, username):
+        """
+        Take the oldest message out of an inbox.
+
+        :param str username: The username
+        :rtype: tuple of [dict, str]|None
+        """
+        messages = self.get_many(username, 1, 0)
+        return messages[0] if messages else None
+
+    def get_many(self, username, max_count, max_bytes):
+        """
+        Take up to max_count of the oldest messages out of an inbox, stopping before
+        max_bytes would be exceeded. The first message is always returned.
+
+        :param str username: The username
+        :param int max_count: The maximum number of messages
+        :param int max_bytes: The maximum combined size of the messages
+        :rtype: list of [tuple of [dict, str]]
+        """
+        if self.shared:
+            self._begin()
+        rows = self._db.execute('SELECT id, headers, body FROM inbox WHERE username = ? '
+                                'ORDER BY id LIMIT ?', (username, max_count))
+        messages = []
+        ids = []
+        total = 0
+        for id, headers, body in rows:
+            headers = json.loads(headers)
+            total += message_size(headers, body)
+            if messages and total > max_bytes:
+                break
+            messages.append((headers, body))
+            ids.append((id,))
+
+        if ids:
+            self._begin()
+            self._db.executemany('DELETE FROM inbox WHERE id = ?', ids)
+        if ids or self.shared:
+            self._written()
+        return messages
+
+    def wait(self, username, timeout):
+        """
+        Block until the inbox holds a message or the timeout expires.
+
+        :param str username: The username
+        :param float timeout: Maximum number of seconds to wait
+        :rtype: bool True if there is a message to fetch
+        """
+        if self._has_messages(username):
+            return True
+        waiter = self._waiters.get(username)
+        if waiter is None:
+            waiter = self._waiters[username] = Event()
+        waiter.wait(timeout)
+        return self._has_messages(username)
+
+    def wake(self, username):
+        """
+        Wake up the waits on an inbox, e.g. when another process has put a message in it.
+
+        :param str username: The username
+        """
+        waiter = self._waiters.pop(username, None)
+        if waiter is not None:
+            waiter.set()
+
+    def size(self, username):
+        row = self._db.execute('SELECT count FROM inbox_sizes WHERE username = ?',
+                               (username,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def total(self):
+        count, = self._db.execute('SELECT COALESCE(SUM(count), 0) FROM inbox_sizes').fetchone()
+        return count
+
+    def largest(self, count):
+        return list(self._db.execute('SELECT username, count FROM inbox_sizes WHERE count > 0 '
+                                     'ORDER BY count DESC LIMIT ?', (count,)))
+
+    def flush(self):
+        """
+        Commit the current write batch to disk.
+        """
+        if self._flusher is not None:
+            self._flusher.kill(block=False)
+            self._flusher = None
+        if self._in_batch:
+            db.execute(self._db, 'COMMIT')
+            self._in_batch = False
+            self._pending = 0
+
+        if self._committed_users:
+            users, self._committed_users = self._committed_users, set()
+            if self.on_commit is not None:
+                for username in users:
+                    self.on_commit(username)
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+    def _create_sizes(self):
+        # the number of messages per user, kept by triggers, so that neither admission nor
+        # the metrics have to count the messages themselves
+        db.execute(self._db, 'BEGIN IMMEDIATE')
+        try:
+            created = self._db.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'inbox_sizes'").fetchone()
+            if created is None:
+                self._db.execute('CREATE TABLE inbox_sizes ('
+                                 'username TEXT PRIMARY KEY, '
+                                 'count INTEGER NOT NULL)')
+                self._db.execute('INSERT INTO inbox_sizes '
+                                 'SELECT username, COUNT(*) FROM inbox GROUP BY username')
+                self._db.execute('CREATE TRIGGER inbox_put AFTER INSERT ON inbox BEGIN '
+                                 'INSERT OR IGNORE INTO inbox_sizes VALUES (NEW.username, 0); '
+                                 'UPDATE inbox_sizes SET count = count + 1 '
+                                 'WHERE username = NEW.username; '
+                                 'END')
+                self._db.execute('CREATE TRIGGER inbox_take AFTER DELETE ON inbox BEGIN '
+                                 'UPDATE inbox_sizes SET count = count - 1 '
+                                 'WHERE username = OLD.username; '
+                                 'END')
+        except:
+            self._db.execute('ROLLBACK')
+            raise
+        db.execute(self._db, 'COMMIT')
+
+    def _has_messages(self, username):
+        return self._db.execute('SELECT 1 FROM inbox WHERE username = ? LIMIT 1',
+                                (username,)).fetchone() is not None
+
+    def _begin(self):
+        if not self._in_batch:
+            # waits for the other processes without blocking this one
+            db.execute(self._db, 'BEGIN IMMEDIATE' if self.shared else 'BEGIN')
+            self._in_batch = True
+
+    def _written(self):
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.flush()
+        elif self._flusher is None:
+            self._flusher = gevent.spawn_later(self.flush_interval, self._scheduled_flush)
+
+    def _scheduled_flush(self):
+        self._flusher = None
+        self.flush()
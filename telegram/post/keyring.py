@@ -0,0 +1,145 @@
+from __future__ import print_function
+import json
+import os
+import time
+import gevent
+from gevent.event import AsyncResult
+from telegram.log import get_logger
+
+log = get_logger(__name__)
+
+
+class RemoteKeyCache(object):
+    def __init__(self, fetcher, ttl=3600, negative_ttl=300, filename=None, retry_interval=60,
+                 store_interval=5):
+        """
+        Cache of public keys of users on other servers.
+
+        Keys are kept for ttl seconds and users without a key for negative_ttl seconds.
+        Concurrent lookups of the same user share one fetch. If a fetch fails, an expired key
+        is used rather than none at all, and the fetch is not tried again for retry_interval
+        seconds. With a filename the cache is stored on disk, at most every store_interval
+        seconds, so it survives a restart.
+
+        :param function fetcher: A function that takes username and domain and returns the
+                                 public key, or None if the user has no key
+        :param int ttl: Seconds to keep a key
+        :param int negative_ttl: Seconds to remember that a user has no key
+        :param str filename: JSON file to persist the cache in
+        :param int retry_interval: Seconds to wait before fetching again after a failure
+        :param float store_interval: Seconds to collect changes before writing the file
+        """
+        self.fetcher = fetcher
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.filename = filename
+        self.retry_interval = retry_interval
+        self.store_interval = store_interval
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._keys = {}
+        """ @type: dict of [unicode, tuple of [unicode|None, float]] """
+        self._fetches = {}
+        """ @type: dict of [unicode, gevent.event.AsyncResult] """
+        self._failures = {}
+        """ @type: dict of [unicode, tuple of [Exception, float]] """
+        self._writer = None
+
+        if filename is not None and os.path.exists(filename):
+            try:
+                with open(filename, 'r') as f:
+                    self._keys = {name: (key, float(expiry))
+                                  for name, (key, expiry) in json.load(f).items()}
+                log.info('Loaded %i remote keys from %s.', len(self._keys), filename)
+            except (IOError, ValueError, TypeError, AttributeError) as e:
+                # only a cache, the keys are fetched again
+                log.warning('Ignoring unreadable remote keys in %s: %s', filename, e)
+
+    def get(self, username, domain):
+        """
+        Get the public key of a remote user.
+
+        :param unicode username: The username, without domain
+        :param unicode domain: The domain of the user's server
+        :rtype: unicode|None The key PEM/PER encoded as a string
+        """
+        name = u'%s@%s' % (username, domain)
+        entry = self._keys.get(name)
+        if entry is not None and entry[1] > time.time():
+            self.hits += 1
+            return entry[0]
+
+        fetch = self._fetches.get(name)
+        if fetch is not None:
+            self.coalesced += 1
+            return fetch.get()
+
+        failure = self._failures.get(name)
+        if failure is not None and failure[1] > time.time():
+            self.hits += 1
+            raise failure[0]
+
+        self.misses += 1
+        fetch = self._fetches[name] = AsyncResult()
+        try:
+            key = self.fetcher(username, domain)
+        except Exception as e:
+            if entry is not None and entry[0] is not None:
+                log.warning('Using expired key for %s: %s', name, e)
+                # keep using it for a while instead of asking the server on every lookup
+                self._keys[name] = (entry[0], time.time() + self.retry_interval)
+                fetch.set(entry[0])
+                return entry[0]
+            self._failures[name] = (e, time.time() + self.retry_interval)
+            fetch.set_exception(e)
+            raise
+        finally:
+            del self._fetches[name]
+        self._failures.pop(name, None)
+
+        ttl = self.ttl if key is not None else self.negative_ttl
+        self._keys[name] = (key, time.time() + ttl)
+        self._store()
+        fetch.set(key)
+        return key
+
+    def invalidate(self, username=None, domain=None):
+        """
+        Forget the key of one remote user, or all remote keys.
+        """
+        if username is None:
+            self._keys.clear()
+        else:
+            self._keys.pop(u'%s@%s' % (username, domain), None)
+        self._failures.clear()
+        self._store()
+
+    def stats(self):
+        return {'size': len(self._keys), 'hits': self.hits, 'misses': self.misses,
+                'coalesced': self.coalesced}
+
+    def flush(self):
+        """
+        Write changes that are waiting for store_interval to the file now.
+        """
+        if self._writer is None:
+            return
+        self._writer.kill(block=False)
+        self._writer = None
+        self._write()
+
+    def _store(self):
+        if self.filename is not None and self._writer is None:
+            self._writer = gevent.spawn_later(self.store_interval, self._scheduled_write)
+
+    def _scheduled_write(self):
+        self._writer = None
+        self._write()
+
+    def _write(self):
+        # the processes of a server with several workers each write their own
+        temp_filename = '%s.%i.tmp' % (self.filename, os.getpid())
+        with open(temp_filename, 'w') as f:
+            json.dump(self._keys, f)
+        os.rename(temp_filename, self.filename)
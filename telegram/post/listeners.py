@@ -0,0 +1,99 @@
+from __future__ import print_function
+import itertools
+import gevent
+from telegram.log import get_logger
+
+log = get_logger(__name__)
+
+
+class ListenerBusy(Exception):
+    pass
+
+
+class ListenerRegistry(object):
+    def __init__(self):
+        """
+        Registry of listener callbacks per user. Every listener gets a handle to unregister
+        it with, and a listener that fails to take a message is unregistered automatically.
+        """
+        self._listeners = {}
+        """ @type: dict of [str, dict of [int, function]] """
+        self._owners = {}
+        """ @type: dict of [int, str] """
+        self._handles = itertools.count(1)
+
+    def add(self, username, callback):
+        """
+        Register a listener callback for a username.
+
+        :param str username: The username
+        :param function callback: The callback(headers, message)
+        :rtype: int A handle for remove()
+        """
+        handle = next(self._handles)
+        self._listeners.setdefault(username, {})[handle] = callback
+        self._owners[handle] = username
+        return handle
+
+    def remove(self, handle):
+        """
+        Unregister a listener. Removing a listener twice is harmless.
+
+        :param int handle: The handle returned by add()
+        :rtype: bool True if the listener was registered
+        """
+        username = self._owners.pop(handle, None)
+        if username is None:
+            return False
+        listeners = self._listeners[username]
+        del listeners[handle]
+        if not listeners:
+            del self._listeners[username]
+        return True
+
+    def count(self, username=None):
+        """
+        The number of listeners of a user, or of all users.
+        """
+        if username is None:
+            return len(self._owners)
+        return len(self._listeners.get(username, ()))
+
+    def deliver(self, username, headers, body):
+        """
+        Hand a message to every listener of a user. Several listeners are called
+        concurrently. Listeners that raise an exception are unregistered, except that a
+        listener may raise ListenerBusy to decline a message for now.
+
+        :param str username: The username
+        :param dict headers: Message headers
+        :param unicode body: Message Body
+        :rtype: int The number of listeners that took the message
+        """
+        listeners = list(self._listeners.get(username, {}).items())
+        if len(listeners) == 1:
+            results = [_call(listeners[0][1], headers, body)]
+        else:
+            greenlets = [gevent.spawn(_call, callback, headers, body)
+                         for handle, callback in listeners]
+            gevent.joinall(greenlets)
+            results = [greenlet.value for greenlet in greenlets]
+
+        deliveries = 0
+        for (handle, callback), delivered in zip(listeners, results):
+            if delivered:
+                deliveries += 1
+            elif delivered is False and self.remove(handle):
+                log.info(u'Removed failing listener for %s', username)
+        return deliveries
+
+
+def _call(callback, headers, body):
+    try:
+        callback(headers, body)
+        return True
+    except ListenerBusy:
+        return None
+    except Exception as e:
+        log.warning('Listener failed: %s', e)
+        return False
@@ -0,0 +1,91 @@
+from __future__ import print_function
+import errno
+import os
+import socket
+import time
+import gevent
+from telegram.log import get_logger
+
+log = get_logger(__name__)
+
+
+class Notifier(object):
+    def __init__(self, directory, callback, refresh_interval=1.0):
+        """
+        Tells the other server processes on this host that a user has new messages in a
+        shared inbox.
+
+        Every process binds a Unix datagram socket named after its pid in a common directory
+        and sends the username to all other sockets found there. Sockets left by processes
+        that are gone are removed.
+
+        :param str directory: The directory shared by the processes
+        :param function callback: Called with the username for each notification received
+        :param float refresh_interval: Seconds between re-reading the directory
+        """
+        self.directory = directory
+        self.callback = callback
+        self.refresh_interval = refresh_interval
+        self.sent = 0
+        self.received = 0
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.address = os.path.join(directory, '%i.sock' % os.getpid())
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self.address)
+        self._peers = []
+        self._peers_read = 0
+        self._reader = gevent.spawn(self._read)
+
+    def notify(self, username):
+        """
+        Tell the other processes that a user has new messages.
+
+        :param str username: The username
+        """
+        data = username.encode('utf-8')
+        for peer in self._get_peers():
+            try:
+                self._sock.sendto(data, peer)
+                self.sent += 1
+            except socket.error as e:
+                if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                    self._remove_peer(peer)
+                else:
+                    log.warning('Notifying %s failed: %s', peer, e)
+
+    def close(self):
+        self._reader.kill()
+        self._sock.close()
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+
+    def _get_peers(self):
+        now = time.time()
+        if now - self._peers_read > self.refresh_interval:
+            self._peers = [os.path.join(self.directory, name)
+                           for name in os.listdir(self.directory)
+                           if name.endswith('.sock')]
+            self._peers = [peer for peer in self._peers if peer != self.address]
+            self._peers_read = now
+        return self._peers
+
+    def _remove_peer(self, peer):
+        if peer in self._peers:
+            self._peers.remove(peer)
+        try:
+            os.unlink(peer)
+        except OSError:
+            pass
+
+    def _read(self):
+        while True:
+            username = self._sock.recv(4096).decode('utf-8')
+            self.received += 1
+            try:
+                self.callback(username)
+            except Exception as e:
+                log.warning('Notification for %s failed: %s', username, e)
@@ -1,26 +1,79 @@
 from __future__ import print_function
 import json
 import os
+import re
+import uuid
 from gevent import monkey; monkey.patch_all()
 from gevent.pool import Pool
-from gevent.queue import Queue, Empty
+from telegram import metrics
+from telegram.auth.crypto_pool import CryptoPool
 from telegram.auth.sign import RSAVerifier, RSASigner
+from telegram.directory import open_directory
+from telegram.post.admission import SenderLimiter, RateLimited, Overloaded, InboxFull
+from telegram.post.history import MessageHistory
+from telegram.post.inbox import MemoryInbox, open_inbox
+from telegram.post.keyring import RemoteKeyCache
+from telegram.post.listeners import ListenerRegistry
+from telegram.post.notify import Notifier
+from telegram.post.outbound import OutboundCourier
 import requests
 from requests.compat import urlunparse
-
+from telegram.log import SAMPLED, get_logger
+
+log = get_logger(__name__)
+
+SORT_SECONDS = metrics.histogram('telegram_sort_seconds', 'Time to sort a message')
+SORTED = metrics.counter('telegram_sorted_total', 'Sorted messages', ['result'])
+INBOUND_SECONDS = metrics.histogram('telegram_inbound_seconds',
+                                    'Time to deliver a message to a local user')
+INBOUND = metrics.counter('telegram_inbound_total', 'Messages to local users', ['route'])
+OUTBOUND_SECONDS = metrics.histogram('telegram_outbound_seconds',
+                                     'Time to sign and queue a message to another server')
+FETCH_SECONDS = metrics.histogram('telegram_fetch_seconds', 'Time to fetch from an inbox')
+FETCHED = metrics.counter('telegram_fetched_total', 'Messages fetched from inboxes')
+REFUSED = metrics.counter('telegram_refused_total', 'Messages refused on admission',
+                          ['reason'])
+SHED = metrics.counter('telegram_shed_total', 'Messages dropped from full inboxes')
+DROPPED = metrics.counter('telegram_dropped_total',
+                          'Accepted messages that could not be delivered', ['reason'])
+REQUEUED = metrics.counter('telegram_requeued_total',
+                           'Unacknowledged messages put back in inboxes')
+
+# the number of inboxes exported with their size, the rest is only in the total
+LARGEST_INBOXES = 10
 
 
 class PostOffice(object):
     def __init__(self, config_dir=None):
-        """ @type: list of [str] """
-        self._inbox = {}
-        """ @type: dict of [str, gevent.queue.Queue] """
+        self._inbox = MemoryInbox()
+        """ @type: MemoryInbox|SQLiteInbox """
         self._worker_pool = Pool(64)
         self._verifier = RSAVerifier(self.get_public_key)
         self._signer = RSASigner(self.get_private_key)
-        self._listeners = {}
+        self._remote_keys = RemoteKeyCache(self._fetch_remote_key)
+        self._courier = OutboundCourier()
+        self._crypto_pool = None
+        self._notifier = None
+        self._listeners = ListenerRegistry()
+        self._long_polls = {}
+        """ @type: dict of [str, int] """
+        self._sequences = {}
+        """ @type: dict of [str, int] """
+        self._history = MessageHistory()
+        self._senders = SenderLimiter()
+        self._peers = SenderLimiter()
+        self._reserved = {}
+        """ @type: dict of [str, int] inbox space of messages admitted, not yet sorted """
+        self.max_long_polls = 4
+        self.key_timeout = 10
+        self.inbox_limit = 0
+        self.inbox_policy = 'reject'
         self.domain = 'localhost'
+        self.settings = {}
         self.users = {}
+        """ @type: dict|SQLiteDirectory """
+        self.directory = None
+        """ @type: SQLiteDirectory """
         if config_dir is not None:
             self.load_config(config_dir)
 
@@ -28,25 +81,200 @@ class PostOffice(object):
         self.users_filename = os.path.join(config_dir, 'users.json')
         self.office_filename = os.path.join(config_dir, 'office.json')
 
-        with open(self.users_filename, 'r') as f:
-            self.users = json.load(f)
-            for username in self.users.keys():
-                self.create_post_box(username)
-
+        settings = self.settings = {}
         try:
             with open(self.office_filename, 'r') as f:
-                settings = json.load(f)
+                settings = self.settings = json.load(f)
                 self.domain = settings.get('domain', 'localhost')
+                self.max_long_polls = settings.get('max_long_polls', 4)
         except:
             pass
 
+        inbox_settings = settings.get('inbox', {})
+        self._inbox = open_inbox(inbox_settings, config_dir)
+        if inbox_settings.get('shared', False):
+            self._notifier = Notifier(
+                os.path.join(config_dir, inbox_settings.get('notify_dir', 'run')),
+                self._on_notification)
+            self._inbox.on_commit = self._notifier.notify
+
+        key_settings = settings.get('remote_keys', {})
+        self._remote_keys = RemoteKeyCache(
+            self._fetch_remote_key,
+            ttl=key_settings.get('ttl', 3600),
+            negative_ttl=key_settings.get('negative_ttl', 300),
+            retry_interval=key_settings.get('retry_interval', 60),
+            filename=os.path.join(config_dir, key_settings.get('path', 'remote_keys.json'))
+            if key_settings.get('persist', True) else None)
+        self.key_timeout = key_settings.get('timeout', 10)
+
+        outbound_settings = settings.get('outbound', {})
+        self._courier = OutboundCourier(
+            batch_size=outbound_settings.get('batch_size', 100),
+            concurrency=outbound_settings.get('concurrency', 4),
+            max_retries=outbound_settings.get('max_retries', 5),
+            backoff=outbound_settings.get('backoff', 1.0),
+            timeout=outbound_settings.get('timeout', 10))
+
+        admission_settings = settings.get('admission', {})
+        self._worker_pool = Pool(admission_settings.get('max_in_flight', 64))
+        self._senders = SenderLimiter(rate=admission_settings.get('sender_rate', 0),
+                                      burst=admission_settings.get('sender_burst'))
+        self._peers = SenderLimiter(rate=admission_settings.get('peer_rate', 0),
+                                    burst=admission_settings.get('peer_burst'))
+        self.inbox_limit = admission_settings.get('inbox_limit', 0)
+        self.inbox_policy = admission_settings.get('inbox_policy', 'reject')
+        assert self.inbox_policy in ('reject', 'shed'),\
+            'Unknown inbox_policy "%s"' % str(self.inbox_policy)
+
+        event_settings = settings.get('events', {})
+        self._history = MessageHistory(size=event_settings.get('history', 0),
+                                       max_users=event_settings.get('history_users', 1000))
+
+        crypto_workers = settings.get('crypto_workers', 0)
+        if crypto_workers and self._crypto_pool is None:
+            self._crypto_pool = CryptoPool(crypto_workers)
+            self._verifier.executor = self._crypto_pool
+            self._signer.executor = self._crypto_pool
+
+        self.invalidate_keys()
+        self.directory = open_directory(settings.get('directory', {}), config_dir)
+        if self.directory is not None:
+            # post boxes are created as the users show up, see _has_post_box()
+            self.users = self.directory
+        else:
+            self.reload_users()
+
+    def reload_users(self):
+        """
+        Read users.json again and apply the differences: create post boxes for new users,
+        remove those of deleted users and forget the parsed keys of changed users. The user
+        table is swapped in one step, so deliveries in progress are not disturbed.
+        """
+        with open(self.users_filename, 'r') as f:
+            users = json.load(f)
+
+        added = [username for username in users if username not in self.users]
+        removed = [username for username in self.users if username not in users]
+        changed = [username for username in users if username in self.users and
+                   _keys(users[username]) != _keys(self.users[username])]
+
+        for username in added:
+            self.create_post_box(username)
+        self.users = users
+        for username in removed:
+            self._inbox.remove(username)
+        for username in removed + changed:
+            self.invalidate_keys(username)
+
+        log.info('Loaded users: %i added, %i removed, %i changed keys.',
+                 len(added), len(removed), len(changed))
+
+    def close(self):
+        """
+        Write any buffered inbox changes and remote keys to disk, release the inbox backend
+        and stop the crypto workers.
+        """
+        self._inbox.close()
+        self._remote_keys.flush()
+        if self._notifier is not None:
+            self._notifier.close()
+        if self.directory is not None:
+            self.directory.close()
+        if self._crypto_pool is not None:
+            self._crypto_pool.close()
+
+    def collect(self):
+        """
+        The current state of the office as metrics, for a metrics.Registry collector.
+
+        :rtype: list of [metrics.Metric]
+        """
+        inbox = metrics.Gauge('telegram_inbox_messages', 'Messages waiting in all inboxes')
+        inbox.set(self._inbox.total())
+        largest = metrics.Gauge('telegram_inbox_largest_messages',
+                                'Messages waiting in the largest inboxes', ['user'])
+        for username, size in self._inbox.largest(LARGEST_INBOXES):
+            largest.labels(username).set(size)
+
+        workers = metrics.Gauge('telegram_worker_pool_greenlets',
+                                'Greenlets of the sorting pool', ['state'])
+        workers.labels('busy').set(len(self._worker_pool))
+        workers.labels('free').set(self._worker_pool.free_count())
+
+        listeners = metrics.Gauge('telegram_listeners', 'Registered listeners')
+        listeners.set(self._listeners.count())
+        long_polls = metrics.Gauge('telegram_long_polls', 'Waiting long-polls')
+        long_polls.set(sum(self._long_polls.values()))
+        history = metrics.Gauge('telegram_history_messages', 'Messages kept for catching up')
+        history.set(self._history.count())
+
+        key_cache = metrics.Gauge('telegram_key_cache_keys', 'Parsed keys in cache', ['cache'])
+        key_lookups = metrics.Counter('telegram_key_cache_lookups_total',
+                                      'Key cache lookups', ['cache', 'result'])
+        for name, cache in (('verify', self._verifier.cache), ('sign', self._signer.cache)):
+            stats = cache.stats()
+            key_cache.labels(name).set(stats['size'])
+            key_lookups.labels(name, 'hit').inc(stats['hits'])
+            key_lookups.labels(name, 'miss').inc(stats['misses'])
+
+        stats = self._remote_keys.stats()
+        remote_keys = metrics.Gauge('telegram_remote_keys', 'Cached keys of remote users')
+        remote_keys.set(stats['size'])
+        remote_lookups = metrics.Counter('telegram_remote_key_lookups_total',
+                                         'Remote key lookups', ['result'])
+        remote_lookups.labels('hit').inc(stats['hits'])
+        remote_lookups.labels('miss').inc(stats['misses'])
+        remote_lookups.labels('coalesced').inc(stats['coalesced'])
+
+        outbound = metrics.Counter('telegram_outbound_total', 'Messages to other servers',
+                                   ['result'])
+        outbound.labels('delivered').inc(self._courier.delivered)
+        outbound.labels('failed').inc(self._courier.failed)
+        outbound_queued = metrics.Gauge('telegram_outbound_queued',
+                                        'Messages waiting to be sent', ['domain'])
+        for domain, size in self._courier.sizes().items():
+            outbound_queued.labels(domain).set(size)
+
+        collected = [inbox, largest, workers, listeners, long_polls, history, key_cache, key_lookups,
+                     remote_keys, remote_lookups, outbound, outbound_queued]
+        if self._notifier is not None:
+            notifications = metrics.Counter('telegram_notifications_total',
+                                            'Notifications between processes', ['direction'])
+            notifications.labels('sent').inc(self._notifier.sent)
+            notifications.labels('received').inc(self._notifier.received)
+            collected.append(notifications)
+        if self._crypto_pool is not None:
+            crypto_calls = metrics.Counter('telegram_crypto_pool_calls_total',
+                                           'Calls to the crypto worker processes')
+            crypto_calls.inc(self._crypto_pool.calls)
+            collected.append(crypto_calls)
+        return collected
+
     def create_post_box(self, username):
         """
         Create a postbox for a user.
 
         :param str username: The username of the post box owner
         """
-        self._inbox[username] = Queue()
+        self._inbox.create(username)
+
+    def _has_post_box(self, username):
+        if username in self._inbox:
+            return True
+        if self.directory is not None and username in self.directory:
+            self.create_post_box(username)
+            return True
+        return False
+
+    def invalidate_keys(self, username=None):
+        """
+        Forget the parsed keys of a user, or of all users, after their keys have changed.
+
+        :param str username: The user whose keys changed, None for everyone
+        """
+        self._verifier.cache.invalidate(username)
+        self._signer.cache.invalidate(username)
 
     def get_public_key(self, username):
         """
@@ -76,10 +304,18 @@ class PostOffice(object):
             elif side == 'private':
                 return user.get('private_key')
         elif side == 'public':
-            url = urlunparse(('https://', domain, '/key/' + username, '', ''))
-            response = requests.get(url)
-            if response.status_code == 200:
-                return response.body
+            return self._remote_keys.get(username, domain)
+
+    def _fetch_remote_key(self, username, domain):
+        url = urlunparse(('https', domain, '/key/' + username, '', '', ''))
+        response = requests.get(url, timeout=self.key_timeout)
+        if response.status_code == 200:
+            return response.text
+        elif response.status_code == 404:
+            return None
+        else:
+            raise IOError('Fetching key for %s@%s failed [%i]' % (
+                username, domain, response.status_code))
 
     def listen(self, username, callback):
         """
@@ -87,23 +323,176 @@ class PostOffice(object):
 
         :param str username: The username
         :param function callback: The callback(headers, message)
+        :rtype: int A handle for unlisten()
         """
-        listeners = self._listeners.get(username)
-        if listeners is None:
-            self._listeners[username] = [callback]
-        else:
-            listeners.append(callback)
-        print(u'Registered listener for ' + username)
+        handle = self._listeners.add(username, callback)
+        log.debug(u'Registered listener for %s', username)
+        return handle
+
+    def unlisten(self, handle):
+        """
+        Unregister a listener callback.
+
+        :param int handle: The handle returned by listen()
+        """
+        self._listeners.remove(handle)
+
+    def _on_notification(self, username):
+        """
+        Another server process has put messages in the shared inbox of a user. Wake up the
+        long-polls on it and hand the messages to the listeners of this process, if any.
+        """
+        if self._has_post_box(username):
+            self._inbox.wake(username)
+            if self._listeners.count(username):
+                self._worker_pool.spawn(self._drain_to_listeners, username)
+
+    def _drain_to_listeners(self, username):
+        while self._listeners.count(username):
+            message = self._inbox.get(username)
+            if message is None:
+                break
+            headers, body = message
+            if self._listeners.deliver(username, headers, body) == 0:
+                self._inbox.put(username, headers, body)
+                break
+
+    def sequence(self, username):
+        """
+        :param str username: The username
+        :rtype: int The x-telegram-seq of the last message delivered to a user by this process
+        """
+        return self._sequences.get(username, 0)
+
+    def history(self, username, seq):
+        """
+        The recent messages of a user after a sequence number, for a client that catches up
+        after losing its connection. Older messages are not kept, and none at all unless
+        "history" is set in the "events" section of office.json.
+
+        :param str username: The username
+        :param int seq: The x-telegram-seq of the last message the client got
+        :rtype: list of [tuple of [dict, str]]
+        """
+        return self._history.since(username, seq)
+
+    def requeue(self, username, messages):
+        """
+        Put messages that a listener took but the client never acknowledged back in the
+        inbox of a user, to be delivered again. They keep their x-telegram-id, by which
+        clients can tell the messages they have already seen.
+
+        :param str username: The username
+        :param list messages: list of [tuple of [dict, str]]
+        """
+        for headers, body in messages:
+            self._inbox.put(username, headers, body)
+        REQUEUED.inc(len(messages))
+        if messages and self._listeners.count(username):
+            self._worker_pool.spawn(self._drain_to_listeners, username)
 
-    def post(self, headers, body, foreign=True):
+    def post(self, headers, body, foreign=True, peer=None):
         """
-        Post a message into this office.
+        Post a message into this office. It is sorted in the background, unless it is
+        refused right away: when max_in_flight messages are being sorted already, when the
+        sender is over its rate, or when the inbox of the receiver is full and the policy is
+        to reject new messages.
+
+        Local messages are limited per sender. The sender of a foreign message is not
+        verified yet, so those are limited per peer, the address of the server posting them.
 
         :param dict headers: Message headers
         :param unicode body: Message Body
         :param bool foreign: True if this message comes from the outside, False otherwise
+        :param str peer: The address of the server posting a foreign message
+        :raises Overloaded: If too many messages are being sorted
+        :raises RateLimited: If the sender posts too fast
+        :raises InboxFull: If the receiver has too many unread messages
+        """
+        headers = _clean_headers(headers)
+        if self._worker_pool.full():
+            REFUSED.labels('overloaded').inc()
+            raise Overloaded(u'Too many messages in flight')
+        reserved = self._admit(headers, foreign, peer)
+        self._worker_pool.spawn(self._sort_posted, headers, body, foreign, reserved)
+
+    def _admit(self, headers, foreign, peer):
+        """
+        Refuse a message, or reserve room for it in the inbox of its receiver. The
+        reservation is released with _release() once the message is sorted.
+
+        :rtype: str|None The username whose inbox room is reserved
+        """
+        try:
+            if not foreign:
+                self._senders.admit(headers.get('x-telegram-from', ''))
+            elif peer is not None:
+                self._peers.admit(peer)
+        except RateLimited:
+            REFUSED.labels('rate_limited').inc()
+            raise
+
+        receiver = headers.get('x-telegram-to')
+        if not self.inbox_limit or receiver is None:
+            return None
+        username, domain = _split_user(receiver, self.domain)
+        if domain != self.domain:
+            return None
+        # count the messages on their way too, or a burst would get past the limit
+        if self.inbox_policy == 'reject' and username in self._inbox and\
+                self._inbox.size(username) + self._reserved.get(username, 0) >= self.inbox_limit:
+            REFUSED.labels('inbox_full').inc()
+            raise InboxFull(u'The inbox of %s is full' % username)
+        self._reserved[username] = self._reserved.get(username, 0) + 1
+        return username
+
+    def _release(self, username):
+        if username is None:
+            return
+        reserved = self._reserved.pop(username) - 1
+        if reserved:
+            self._reserved[username] = reserved
+
+    def _sort_posted(self, headers, body, foreign, reserved):
+        # the poster was answered already, so failures only show in the log and metrics
+        try:
+            self._sort(headers, body, foreign=foreign)
+        except InboxFull as e:
+            DROPPED.labels('inbox_full').inc()
+            log.warning(u'Dropped an accepted message: %s', e)
+        finally:
+            self._release(reserved)
+
+    def post_many(self, messages, peer=None):
+        """
+        Post a batch of signed messages from another server into this office, and wait until
+        they are sorted.
+
+        :param list messages: The messages, as tuples of [dict, unicode] headers and body
+        :param str peer: The address of the server posting them
+        :rtype: list of [dict] One {"status": 201} or {"status": 4xx, "error": "..."} per message
         """
-        self._worker_pool.spawn(self._sort, _clean_headers(headers), body, foreign=False)
+        return self._worker_pool.map(lambda message: self._sort_foreign(message, peer),
+                                     messages)
+
+    def _sort_foreign(self, message, peer=None):
+        # one bad message must not fail the batch, the others may be sorted already
+        reserved = None
+        try:
+            headers, body = message
+            reserved = self._admit(_clean_headers(headers), True, peer)
+            self._sort(headers, body, foreign=True)
+        except AssertionError as e:
+            return {'status': 400, 'error': str(e)}
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            return {'status': 400, 'error': 'Malformed message: %s' % str(e)}
+        except (RateLimited, InboxFull) as e:
+            return {'status': 429, 'error': str(e)}
+        except IOError as e:
+            return {'status': 503, 'error': str(e)}
+        finally:
+            self._release(reserved)
+        return {'status': 201}
 
     def fetch(self, username):
         """
@@ -112,12 +501,54 @@ class PostOffice(object):
         :param str username: The username
         :rtype: tuple of [dict, str]|None
         """
-        assert username in self._inbox.keys(), 'No inbox for user'
+        assert self._has_post_box(username), 'No inbox for user'
+        with FETCH_SECONDS.time():
+            message = self._inbox.get(username)
+        if message is not None:
+            FETCHED.inc()
+        return message
+
+    def wait(self, username, timeout):
+        """
+        Long-poll the inbox of a user: block until it holds a message or the timeout expires.
+        At most max_long_polls waits per user are allowed at the same time.
+
+        :param str username: The username
+        :param float timeout: Maximum number of seconds to wait
+        :rtype: bool True if there is a message to fetch
+        """
+        assert self._has_post_box(username), 'No inbox for user'
+        waiting = self._long_polls.get(username, 0)
+        if waiting >= self.max_long_polls:
+            raise LongPollLimit(u'Too many long-polls for %s' % username)
+
+        self._long_polls[username] = waiting + 1
         try:
-            return self._inbox[username].get_nowait()
-        except Empty:
-            return None
+            return self._inbox.wait(username, timeout)
+        finally:
+            waiting = self._long_polls[username] - 1
+            if waiting:
+                self._long_polls[username] = waiting
+            else:
+                del self._long_polls[username]
+
+    def fetch_many(self, username, max_count, max_bytes):
+        """
+        Drain up to max_count messages, at most about max_bytes in total, from the inbox of a
+        user in one go. Returns an empty list if the inbox is empty.
 
+        :param str username: The username
+        :param int max_count: The maximum number of messages
+        :param int max_bytes: The maximum combined size of the messages
+        :rtype: list of [tuple of [dict, str]]
+        """
+        assert self._has_post_box(username), 'No inbox for user'
+        with FETCH_SECONDS.time():
+            messages = self._inbox.get_many(username, max_count, max_bytes)
+        FETCHED.inc(len(messages))
+        return messages
+
+    @SORT_SECONDS.time()
     def _sort(self, headers, body, foreign=True):
         """
         Do local sorting without any verification; the source is local.
@@ -126,6 +557,17 @@ class PostOffice(object):
         :param unicode body: Message Body
         :param bool foreign: True if this message comes from the outside, False otherwise
         """
+        try:
+            self._sort_message(headers, body, foreign)
+        except AssertionError:
+            SORTED.labels('rejected').inc()
+            raise
+        except Exception:
+            SORTED.labels('failed').inc()
+            raise
+        SORTED.labels('sorted').inc()
+
+    def _sort_message(self, headers, body, foreign):
         headers = _clean_headers(headers)
         body = _clean_body(body)
 
@@ -149,8 +591,8 @@ class PostOffice(object):
         receiver_username, receiver_domain = _split_user(receiver, self.domain)
         sender_username, sender_domain = _split_user(sender, self.domain)
 
-        print(u'Sorting %s@%s --> %s@%s' % (sender_username, sender_domain,
-                                            receiver_username, receiver_domain))
+        log.debug(u'Sorting %s@%s --> %s@%s', sender_username, sender_domain,
+                  receiver_username, receiver_domain, extra=SAMPLED)
 
         if receiver_domain == self.domain: # the message should go here
             self._deliver_inbound(receiver_username, headers, body)
@@ -158,28 +600,42 @@ class PostOffice(object):
             self._deliver_outbound(sender_username, receiver_username,receiver_domain,
                                    headers, body)
 
-        print('Sorting done')
-
+    @INBOUND_SECONDS.time()
     def _deliver_inbound(self, username, headers, body):
-        print('Inbound message to %s.' % username)
-        assert username in self._inbox.keys(),\
+        assert self._has_post_box(username),\
             'There is no such user or group on this server'
 
-        deliveries = 0
-        for listener in self._listeners.get(username, []):
-            try:
-                listener(headers, body)
-                deliveries += 1
-            except:
-                pass
+        # set here, so that a sender cannot choose them
+        headers['x-telegram-id'] = uuid.uuid4().hex
+        headers['x-telegram-seq'] = str(self._next_seq(username))
+        deliveries = self._listeners.deliver(username, headers, body)
 
         if deliveries == 0:
-            self._inbox[username].put((headers, body))
+            self._make_room(username)
+            self._inbox.put(username, headers, body)
+            INBOUND.labels('inbox').inc()
+        else:
+            INBOUND.labels('listener').inc()
+        self._history.record(username, headers, body)
+
+    def _next_seq(self, username):
+        seq = self._sequences[username] = self._sequences.get(username, 0) + 1
+        return seq
+
+    def _make_room(self, username):
+        if not self.inbox_limit or self._inbox.size(username) < self.inbox_limit:
+            return
+        if self.inbox_policy == 'shed':
+            self._inbox.get(username)
+            SHED.inc()
+        else:
+            REFUSED.labels('inbox_full').inc()
+            raise InboxFull(u'The inbox of %s is full' % username)
 
+    @OUTBOUND_SECONDS.time()
     def _deliver_outbound(self, sender_username, receiver_username, receiver_domain, 
                           headers, body):
-        print('Outbound message to %s.' % (receiver_username, receiver_domain))
-        assert sender_username in self.users.keys(),\
+        assert sender_username in self.users,\
             'There is no such user or group on this server (sender %s unknown)'\
             % sender_username
 
@@ -190,12 +646,12 @@ class PostOffice(object):
         headers['x-telegram-sign'] = sign
         headers['x-telegram-from'] = u'%s@%s' % (sender_username, self.domain)
 
-        url = urlunparse(('https://', domain, '/send', '', ''))
-        response = requests.post(url, headers=headers, data=body)
-        if response.status_code != 201:
-            print(response.body)
+        self._courier.send(receiver_domain, headers, body)
 
 
+class LongPollLimit(Exception):
+    pass
+
 
 def _clean_headers(headers):
     lower = {str(k.lower()): str(v) for k, v in headers.items()}
@@ -203,21 +659,62 @@ def _clean_headers(headers):
 
 
 def _clean_body(body):
-    tag = False
-    quote = False
-    out = ""
-
-    for c in body:
-        if c == '<' and not quote:
-            tag = True
-        elif c == '>' and not quote:
-            tag = False
-        elif c in ("'", '"') and tag:
-            quote = not quote
-        elif not tag:
-            out += c
-
-    return out
+    return _BodyCleaner().feed(body)
+
+
+_OUTSIDE_TAG = re.compile(r'[<>]')
+_INSIDE_TAG = re.compile(r'[>\'"]')
+_INSIDE_QUOTE = re.compile(r'[\'"]')
+
+
+class _BodyCleaner(object):
+    """
+    Strips tags from a message body in linear time. The body can be fed in chunks; the
+    tag and quote state carries over from one chunk to the next.
+
+    Everything from a < to the next > is dropped, except that a > inside a quoted part of
+    the tag does not end it. A stray > outside of a tag is dropped as well.
+    """
+    def __init__(self):
+        self.tag = False
+        self.quote = False
+
+    def feed(self, chunk):
+        """
+        Clean the next chunk of a body.
+
+        :param unicode chunk: The next part of the body
+        :rtype: unicode The text of the chunk that lies outside of tags
+        """
+        out = []
+        pos = 0
+        while pos < len(chunk):
+            if self.quote:
+                match = _INSIDE_QUOTE.search(chunk, pos)
+                if match is None:
+                    break
+                self.quote = False
+            elif self.tag:
+                match = _INSIDE_TAG.search(chunk, pos)
+                if match is None:
+                    break
+                if match.group() == '>':
+                    self.tag = False
+                else:
+                    self.quote = True
+            else:
+                match = _OUTSIDE_TAG.search(chunk, pos)
+                if match is None:
+                    out.append(chunk[pos:])
+                    break
+                out.append(chunk[pos:match.start()])
+                self.tag = match.group() == '<'
+            pos = match.end()
+        return ''.join(out)
+
+def _keys(user):
+    return user.get('public_key'), user.get('private_key')
+
 
 def _split_user(username, default_domain):
     if '@' in username:
@@ -0,0 +1,156 @@
+from __future__ import print_function
+import json
+import gevent
+from gevent.queue import Queue, Empty
+import requests
+from requests.adapters import HTTPAdapter
+from telegram.log import get_logger
+
+log = get_logger(__name__)
+
+
+class OutboundCourier(object):
+    def __init__(self, batch_size=100, concurrency=4, max_retries=5, backoff=1.0,
+                 idle_timeout=30, timeout=10):
+        """
+        Delivers messages to other servers.
+
+        Messages are queued per destination domain and sent by at most concurrency workers
+        per domain, which share keep-alive connections and send up to batch_size queued
+        messages in a single POST to /send/batch. Failed batches, and messages the other
+        server could not take for now (429 or 5xx), are retried with exponential backoff.
+        Workers stop after idle_timeout seconds without messages.
+
+        :param int batch_size: The maximum number of messages per request
+        :param int concurrency: The maximum number of concurrent requests per domain
+        :param int max_retries: How many times to retry a failed batch
+        :param float backoff: Seconds to wait before the first retry, doubled for each retry
+        :param float idle_timeout: Seconds before an idle worker stops
+        :param float timeout: Seconds to wait for the other server to connect and to answer
+        """
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.delivered = 0
+        self.failed = 0
+        self._queues = {}
+        """ @type: dict of [str, gevent.queue.Queue] """
+        self._workers = {}
+        """ @type: dict of [str, int] """
+        self._session = requests.Session()
+        self._session.mount('https://', HTTPAdapter(pool_connections=64,
+                                                    pool_maxsize=concurrency))
+
+    def send(self, domain, headers, body):
+        """
+        Queue a signed message for delivery to another server.
+
+        :param str domain: The domain of the receiving server
+        :param dict headers: Message headers
+        :param unicode body: Message Body
+        """
+        queue = self._queues.get(domain)
+        if queue is None:
+            queue = self._queues[domain] = Queue()
+        queue.put((headers, body))
+
+        workers = self._workers.get(domain, 0)
+        if workers < self.concurrency and workers < queue.qsize():
+            self._workers[domain] = workers + 1
+            gevent.spawn(self._work, domain, queue)
+
+    def queued(self, domain):
+        queue = self._queues.get(domain)
+        return 0 if queue is None else queue.qsize()
+
+    def sizes(self):
+        """
+        :rtype: dict of [str, int] The number of queued messages for each domain
+        """
+        return {domain: queue.qsize() for domain, queue in self._queues.items()}
+
+    def _work(self, domain, queue):
+        try:
+            while True:
+                try:
+                    batch = [queue.get(timeout=self.idle_timeout)]
+                except Empty:
+                    return
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(queue.get_nowait())
+                    except Empty:
+                        break
+                self._deliver(domain, batch)
+        finally:
+            self._workers[domain] -= 1
+
+    def _deliver(self, domain, batch):
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                gevent.sleep(min(self.backoff * 2 ** (attempt - 1), 60))
+            try:
+                results = self._post(domain, batch)
+            except (requests.RequestException, ValueError) as e:
+                log.warning('Outbound batch to %s failed (attempt %i): %s',
+                            domain, attempt + 1, e)
+                continue
+            if results is None:
+                continue
+
+            if len(results) != len(batch):
+                log.warning('Outbound batch to %s got %i results for %i messages',
+                            domain, len(results), len(batch))
+            retry = batch[len(results):]
+            for (headers, body), result in zip(batch, results):
+                status = result.get('status') if isinstance(result, dict) else None
+                if status == 201:
+                    self.delivered += 1
+                elif status == 429 or (status or 0) >= 500:
+                    retry.append((headers, body))  # overloaded for now, not refused
+                else:
+                    self.failed += 1
+                    log.warning('Outbound message to %s rejected: %s',
+                                headers.get('x-telegram-to'), json.dumps(result))
+            if not retry:
+                return
+            log.info('Outbound batch to %s: %i messages deferred', domain, len(retry))
+            batch = retry
+
+        self.failed += len(batch)
+        log.error('Giving up on %i messages to %s.', len(batch), domain)
+
+    def _post(self, domain, batch):
+        """
+        Send a batch to /send/batch, one JSON object per line. The answer has one result per
+        message: {"results": [{"status": 201}, {"status": 400, "error": "..."}, ...]}.
+
+        Servers without /send/batch get the messages one by one on /send.
+
+        :rtype: list of [dict]|None The results, or None if the batch should be retried
+        """
+        data = '\n'.join(json.dumps({'headers': headers, 'body': body})
+                         for headers, body in batch)
+        response = self._session.post('https://%s/send/batch' % domain, data=data,
+                                      headers={'Content-Type': 'application/x-ndjson'},
+                                      timeout=self.timeout)
+
+        if response.status_code == 200:
+            return response.json()['results']
+        elif response.status_code in (404, 405):
+            return [self._post_single(domain, headers, body) for headers, body in batch]
+        elif response.status_code in (429, 503) or response.status_code >= 500:
+            log.info('Outbound batch to %s deferred [%i]', domain, response.status_code)
+            return None
+        else:
+            return [{'status': response.status_code, 'error': response.text}] * len(batch)
+
+    def _post_single(self, domain, headers, body):
+        response = self._session.post('https://%s/send' % domain, headers=headers,
+                                      data=body, timeout=self.timeout)
+        if response.status_code == 201:
+            return {'status': 201}
+        return {'status': response.status_code, 'error': response.text}
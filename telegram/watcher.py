@@ -0,0 +1,63 @@
+from __future__ import print_function
+import os
+import gevent
+from telegram.log import get_logger
+
+log = get_logger(__name__)
+
+
+class FileWatcher(object):
+    def __init__(self, interval=2.0):
+        """
+        Calls a callback when a file changes, found by polling its modification time, size
+        and inode every interval seconds.
+
+        :param float interval: Seconds between checks
+        """
+        self.interval = interval
+        self._files = {}
+        """ @type: dict of [str, list of [tuple|None, function]] """
+        self._greenlet = None
+
+    def watch(self, filename, callback):
+        """
+        Start watching a file. The callback is not called for the current state of the file.
+
+        :param str filename: The file to watch
+        :param function callback: Called without arguments when the file has changed; if it
+                                  raises, the error is logged and the old state is kept
+                                  until the file changes again
+        """
+        self._files[filename] = [_signature(filename), callback]
+
+    def check(self):
+        for filename, watched in self._files.items():
+            signature = _signature(filename)
+            if signature is None or signature == watched[0]:
+                continue
+            watched[0] = signature
+            try:
+                watched[1]()
+            except Exception as e:
+                log.warning('Reloading %s failed: %s', filename, e)
+
+    def start(self):
+        self._greenlet = gevent.spawn(self._run)
+
+    def stop(self):
+        if self._greenlet is not None:
+            self._greenlet.kill()
+            self._greenlet = None
+
+    def _run(self):
+        while True:
+            gevent.sleep(self.interval)
+            self.check()
+
+
+def _signature(filename):
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size, stat.st_ino
@@ -0,0 +1,36 @@
+from __future__ import print_function
+import unittest
+from telegram.connections import ConnectionManager
+from telegram.framing import get_framing
+
+
+class DeadSocket(object):
+    closed = False
+
+    def send(self, data):
+        raise IOError('Broken pipe')
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionTest(unittest.TestCase):
+    def test_failed_batch_is_kept_for_redelivery(self):
+        manager = ConnectionManager()
+        connection = manager.open('bob', DeadSocket(), get_framing('json'))
+        requeued = []
+        connection.on_close.append(lambda: requeued.extend(connection.unacked.values()))
+        messages = [{'headers': {'x-telegram-id': 'one'}, 'body': u'first'},
+                    {'headers': {}, 'body': u'from an older version'}]
+
+        with self.assertRaises(IOError):
+            connection.deliver_many(messages)
+        manager.close(connection)
+
+        self.assertEqual([body for headers, body in requeued],
+                         [u'first', u'from an older version'])
+        self.assertTrue(all('x-telegram-id' in headers for headers, body in requeued))
+
+
+if __name__ == '__main__':
+    unittest.main()
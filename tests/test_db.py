@@ -0,0 +1,51 @@
+from __future__ import print_function
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+import gevent
+from telegram import db
+
+
+class ExecuteTest(unittest.TestCase):
+    def setUp(self):
+        self.config_dir = tempfile.mkdtemp()
+        filename = os.path.join(self.config_dir, 'test.db')
+        self.holder = db.connect(filename)
+        self.holder.execute('PRAGMA journal_mode=WAL')
+        self.holder.execute('CREATE TABLE t (n INTEGER)')
+        self.waiter = db.connect(filename)
+
+    def tearDown(self):
+        self.holder.close()
+        self.waiter.close()
+        shutil.rmtree(self.config_dir)
+
+    def test_waiting_for_the_lock_lets_other_greenlets_run(self):
+        self.holder.execute('BEGIN IMMEDIATE')
+        ticks = []
+
+        def tick():
+            for n in range(5):
+                ticks.append(n)
+                gevent.sleep(0.01)
+            self.holder.execute('COMMIT')
+
+        ticker = gevent.spawn(tick)
+        db.execute(self.waiter, 'BEGIN IMMEDIATE')
+        db.execute(self.waiter, 'COMMIT')
+        ticker.join()
+        self.assertEqual(ticks, [0, 1, 2, 3, 4])
+
+    def test_gives_up_after_timeout(self):
+        self.holder.execute('BEGIN IMMEDIATE')
+        started = time.time()
+        with self.assertRaises(sqlite3.OperationalError):
+            db.execute(self.waiter, 'BEGIN IMMEDIATE', timeout=0.1)
+        self.assertLess(time.time() - started, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
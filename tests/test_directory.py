@@ -0,0 +1,52 @@
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import unittest
+import gevent
+from telegram import db
+from telegram.directory import SQLiteDirectory
+
+
+class ImportTest(unittest.TestCase):
+    def setUp(self):
+        self.config_dir = tempfile.mkdtemp()
+        self.directory = SQLiteDirectory(os.path.join(self.config_dir, 'users.db'))
+
+    def tearDown(self):
+        self.directory.close()
+        shutil.rmtree(self.config_dir)
+
+    def test_import_skips_existing_users(self):
+        self.directory.add('alice', {'fullname': 'Alice'}, 'a1')
+        skipped = self.directory.import_users(
+            {'alice': {'fullname': 'Imported'}, 'bob': {'fullname': 'Bob'}},
+            {'alice': 'a2', 'bob': 'b1'})
+
+        self.assertEqual(skipped, ['alice'])
+        self.assertEqual(self.directory.get('alice')['fullname'], 'Alice')
+        self.assertEqual(self.directory.get_password('alice'), 'a1')
+        self.assertEqual(self.directory.get_password('bob'), 'b1')
+
+    def test_writes_wait_for_an_import_without_blocking(self):
+        self.directory.add('alice', {}, 'a1')
+        importer = db.connect(self.directory.filename)
+        importer.execute('BEGIN IMMEDIATE')
+        ticks = []
+
+        def tick():
+            for n in range(5):
+                ticks.append(n)
+                gevent.sleep(0.01)
+            importer.execute('COMMIT')
+
+        ticker = gevent.spawn(tick)
+        self.directory.set_password('alice', 'a2')
+        ticker.join()
+        importer.close()
+        self.assertEqual(ticks, [0, 1, 2, 3, 4])
+        self.assertEqual(self.directory.get_password('alice'), 'a2')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+from __future__ import print_function
+import time
+import unittest
+import zlib
+from telegram.framing import decode, encode, MAX_DEPTH, MAX_FRAME_SIZE
+
+
+class FramingTest(unittest.TestCase):
+    def test_round_trip(self):
+        frame = {'status': 200, 'request': 'new', 'messages': [
+            {'headers': {'x-telegram-from': 'alice'}, 'body': u'hall\xe5 ' * 100}],
+            'max': -2 ** 63, 'ok': True, 'error': None, 'load': 0.5}
+        self.assertEqual(decode(encode(frame)), frame)
+        self.assertEqual(decode(encode(frame, 0)), frame)
+
+    def test_malformed_frames_raise_value_error(self):
+        frames = [
+            b'', b'\x00', b'\x00\x99', b'\x00\x07\x01',  # unknown tag, short float
+            b'\x00\x06\x01\x05\x00\x03\x00',  # a list as a dict key
+            b'\x00' + b'\x05\x01' * (MAX_DEPTH + 2) + b'\x00',
+            b'\x00\x00\x00',  # trailing bytes
+            b'\x01not deflated',
+            b'\x01' + zlib.compress(b'\x00' * (17 * 1024 * 1024)),
+            u'{"not": json',
+        ]
+        for frame in frames:
+            with self.assertRaises(ValueError):
+                decode(frame)
+
+    def test_large_integers_are_refused(self):
+        with self.assertRaises(ValueError):
+            encode({'max': 2 ** 63})
+
+    def test_long_varints_are_refused(self):
+        # deflates to a small frame, but would take hours to read as one integer
+        frame = b'\x01' + zlib.compress(b'\x03' + b'\xff' * (MAX_FRAME_SIZE - 2) + b'\x01')
+        started = time.time()
+        with self.assertRaises(ValueError):
+            decode(frame)
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual(decode(encode({'max': -2 ** 63})), {'max': -2 ** 63})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+from __future__ import print_function
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from telegram.post.inbox import MemoryInbox, SQLiteInbox
+
+
+class SizesTest(unittest.TestCase):
+    def setUp(self):
+        self.config_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.config_dir, 'inbox.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.config_dir)
+
+    def fill(self, inbox):
+        for username, count in (('alice', 4), ('bob', 1), ('carol', 3)):
+            inbox.create(username)
+            for n in range(count):
+                inbox.put(username, {'x-telegram-id': str(n)}, u'body')
+        inbox.get_many('carol', 1, 1024)
+
+    def test_memory_inbox(self):
+        inbox = MemoryInbox()
+        self.fill(inbox)
+        self.assertEqual(inbox.total(), 7)
+        self.assertEqual(inbox.largest(2), [('alice', 4), ('carol', 2)])
+
+    def test_sqlite_inbox_counts_across_processes(self):
+        inbox = SQLiteInbox(self.filename, shared=True)
+        other = SQLiteInbox(self.filename, shared=True)
+        self.fill(inbox)
+        other.get_many('alice', 3, 1024)
+        other.flush()
+
+        self.assertEqual(inbox.total(), 4)
+        self.assertEqual(inbox.size('alice'), 1)
+        self.assertEqual(inbox.size('nobody'), 0)
+        self.assertEqual(inbox.largest(1), [('carol', 2)])
+        inbox.close()
+        other.close()
+
+    def test_sqlite_inbox_counts_messages_stored_before_upgrade(self):
+        old = sqlite3.connect(self.filename)
+        old.execute('CREATE TABLE inbox (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                    'username TEXT NOT NULL, headers TEXT NOT NULL, body TEXT NOT NULL)')
+        old.executemany('INSERT INTO inbox (username, headers, body) VALUES (?, ?, ?)',
+                        [('alice', '{}', u'a')] * 2 + [('bob', '{}', u'b')])
+        old.commit()
+        old.close()
+
+        inbox = SQLiteInbox(self.filename)
+        self.assertEqual(inbox.total(), 3)
+        self.assertEqual(inbox.largest(1), [('alice', 2)])
+        inbox.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
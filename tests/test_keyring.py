@@ -0,0 +1,67 @@
+from __future__ import print_function
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import gevent
+from telegram.post.keyring import RemoteKeyCache
+
+
+class Fetcher(object):
+    def __init__(self, key):
+        self.key = key
+        self.calls = 0
+
+    def __call__(self, username, domain):
+        self.calls += 1
+        if isinstance(self.key, Exception):
+            raise self.key
+        return self.key
+
+
+class RemoteKeyCacheTest(unittest.TestCase):
+    def test_failed_fetch_is_not_retried_at_once(self):
+        fetcher = Fetcher(u'KEY')
+        cache = RemoteKeyCache(fetcher, ttl=0, retry_interval=60)
+        self.assertEqual(cache.get('alice', 'example.com'), u'KEY')
+
+        fetcher.key = IOError('down')
+        for n in range(3):
+            self.assertEqual(cache.get('alice', 'example.com'), u'KEY')
+        self.assertEqual(fetcher.calls, 2)
+
+        for n in range(3):
+            self.assertRaises(IOError, cache.get, 'bob', 'example.com')
+        self.assertEqual(fetcher.calls, 3)
+
+    def test_writes_are_deferred(self):
+        config_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(config_dir, 'remote_keys.json')
+            cache = RemoteKeyCache(Fetcher(u'KEY'), filename=filename, store_interval=0.05)
+            cache.get('alice', 'example.com')
+            cache.get('bob', 'example.com')
+            self.assertFalse(os.path.exists(filename))
+            gevent.sleep(0.1)
+            with open(filename) as f:
+                self.assertEqual(sorted(json.load(f)), [u'alice@example.com', u'bob@example.com'])
+        finally:
+            shutil.rmtree(config_dir)
+
+    def test_corrupt_file_is_ignored(self):
+        config_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(config_dir, 'remote_keys.json')
+            for content in ('{"alice@example.com": ["KEY", 1', '["KEY"]',
+                            '{"alice@example.com": 3}'):
+                with open(filename, 'w') as f:
+                    f.write(content)
+                cache = RemoteKeyCache(Fetcher(u'KEY'), filename=filename)
+                self.assertEqual(cache.get('alice', 'example.com'), u'KEY')
+        finally:
+            shutil.rmtree(config_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+from __future__ import print_function
+import unittest
+import gevent
+from telegram.auth.sign import generate_key_pair, sign_text, KeyCache
+from telegram.post.admission import InboxFull, RateLimited, SenderLimiter
+from telegram.post.office import PostOffice
+
+
+class PostManyTest(unittest.TestCase):
+    def setUp(self):
+        private_key, public_key = generate_key_pair('alice')
+        self.private_key = private_key.decode('ascii')
+        self.office = PostOffice()
+        self.office.users = {
+            'alice': {'public_key': public_key.decode('ascii')},
+            'bob': {},
+        }
+        self.office.create_post_box('bob')
+
+    def message(self, body, sign=None):
+        headers = {
+            'x-telegram-from': 'alice@localhost',
+            'x-telegram-to': 'bob@localhost',
+            'x-telegram-sign': sign or sign_text(KeyCache(), 'alice', self.private_key, body),
+        }
+        return headers, body
+
+    def test_bad_messages_do_not_fail_the_batch(self):
+        results = self.office.post_many([
+            self.message(u'first'),
+            self.message(u'not base64', sign='%%%'),
+            ('not a dict', u'body'),
+            self.message(u'bad signature', sign=self.message(u'other')[0]['x-telegram-sign']),
+            (self.message(u'body')[0], 42),
+            ('too', 'many', 'parts'),
+            self.message(u'last'),
+        ])
+
+        self.assertEqual([result['status'] for result in results],
+                         [201, 400, 400, 400, 400, 400, 201])
+        bodies = [body for headers, body in self.office.fetch_many('bob', 10, 1024 * 1024)]
+        self.assertEqual(bodies, [u'first', u'last'])
+
+
+class AdmissionTest(unittest.TestCase):
+    def setUp(self):
+        self.office = PostOffice()
+        self.office.users = {'alice': {}, 'bob': {}}
+        self.office.create_post_box('bob')
+
+    def tearDown(self):
+        # the foreign messages would be verified against keys fetched from example.com
+        self.office._worker_pool.kill()
+
+    def message(self, sender):
+        return {'X-Telegram-From': sender, 'X-Telegram-To': 'bob'}, u'hi'
+
+    def test_foreign_messages_are_limited_per_peer(self):
+        self.office._senders = SenderLimiter(rate=1, burst=1)
+        self.office._peers = SenderLimiter(rate=1, burst=2)
+        self.office.post(*self.message('alice@example.com'), foreign=True, peer='10.0.0.1')
+        # another claimed sender does not get a bucket of its own
+        self.office.post(*self.message('mallory@example.com'), foreign=True, peer='10.0.0.1')
+        with self.assertRaises(RateLimited):
+            self.office.post(*self.message('eve@example.com'), foreign=True, peer='10.0.0.1')
+        # nor can it spend the bucket of a local sender
+        self.office.post(*self.message('alice'), foreign=False)
+
+    def test_inbox_limit_counts_messages_in_flight(self):
+        self.office.inbox_limit = 2
+        self.office.post(*self.message('alice'), foreign=False)
+        self.office.post(*self.message('alice'), foreign=False)
+        with self.assertRaises(InboxFull):
+            self.office.post(*self.message('alice'), foreign=False)
+        gevent.sleep(0.1)
+        self.assertEqual(self.office._inbox.size('bob'), 2)
+        self.assertEqual(self.office._reserved, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
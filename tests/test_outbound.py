@@ -0,0 +1,42 @@
+from __future__ import print_function
+import unittest
+from telegram.post.outbound import OutboundCourier
+
+
+class DeliverTest(unittest.TestCase):
+    def setUp(self):
+        self.courier = OutboundCourier(max_retries=2, backoff=0.001)
+        self.posted = []
+
+    def post(self, answers):
+        answers = iter(answers)
+
+        def _post(domain, batch):
+            self.posted.append([body for headers, body in batch])
+            return next(answers)(batch)
+        self.courier._post = _post
+
+    def message(self, body):
+        return {'x-telegram-to': 'bob@example.com'}, body
+
+    def test_overloaded_and_missing_results_are_retried(self):
+        self.post([
+            lambda batch: [{'status': 201}, {'status': 429}, {'status': 400},
+                           {'status': 503}],
+            lambda batch: [{'status': 201}] * len(batch),
+        ])
+        self.courier._deliver('example.com', [self.message(body) for body in 'abcde'])
+
+        self.assertEqual(self.posted, [list('abcde'), list('ebd')])
+        self.assertEqual((self.courier.delivered, self.courier.failed), (4, 1))
+
+    def test_gives_up_after_max_retries(self):
+        self.post([lambda batch: [{'status': 503}]] * 3)
+        self.courier._deliver('example.com', [self.message(u'a')])
+
+        self.assertEqual(len(self.posted), 3)
+        self.assertEqual((self.courier.delivered, self.courier.failed), (0, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
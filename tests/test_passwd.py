@@ -0,0 +1,44 @@
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import unittest
+from telegram.auth.internal import InternalAuth
+from telegram.auth.passwords import hash_password
+from telegram.directory import read_passwd, update_passwd
+
+
+class PasswdTest(unittest.TestCase):
+    def setUp(self):
+        self.config_dir = tempfile.mkdtemp()
+        self.passwd_filename = os.path.join(self.config_dir, 'passwd')
+
+    def tearDown(self):
+        shutil.rmtree(self.config_dir)
+
+    def test_update_keeps_other_lines(self):
+        update_passwd(self.passwd_filename, {'alice': 'a1', 'bob': 'b1'})
+        update_passwd(self.passwd_filename, {'bob': 'b2', 'carol': 'c1'})
+        self.assertEqual(read_passwd(self.passwd_filename),
+                         {'alice': 'a1', 'bob': 'b2', 'carol': 'c1'})
+
+    def test_update_without_replace_keeps_existing_hashes(self):
+        update_passwd(self.passwd_filename, {'alice': 'a1'})
+        kept = update_passwd(self.passwd_filename, {'alice': 'a2', 'bob': 'b1'}, replace=False)
+        self.assertEqual(kept, ['alice'])
+        self.assertEqual(read_passwd(self.passwd_filename), {'alice': 'a1', 'bob': 'b1'})
+
+    def test_rehash_keeps_users_added_since_loading(self):
+        update_passwd(self.passwd_filename, {'alice': hash_password(u'pw', cost=1000)})
+        auth = InternalAuth(self.config_dir)
+        update_passwd(self.passwd_filename, {'bob': 'added by telegram_admin'})
+
+        self.assertTrue(auth.authenticate('alice', u'pw'))
+
+        passwords = read_passwd(self.passwd_filename)
+        self.assertEqual(passwords['bob'], 'added by telegram_admin')
+        self.assertEqual(passwords['alice'], auth._users['alice'])
+
+
+if __name__ == '__main__':
+    unittest.main()